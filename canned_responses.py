@@ -0,0 +1,48 @@
+import random
+import sqlite3
+
+
+class CannedResponses:
+    """
+    Trigger word => list of responses, e.g. every message containing "undertale" gets a random undertale line back.
+    The corpora are read into memory once, so picking a response is a random index into a list no matter how the
+    ids in the source table are numbered. Finding the trigger words in a message is up to TriggerScanner.
+    """
+
+    def __init__(self, log=None):
+        self.log = log if log is not None else print
+        self.responses = {}  # lower case trigger => list of responses
+
+    def __len__(self):
+        return len(self.responses)
+
+    def add(self, trigger, responses):
+        responses = [response for response in responses if response is not None and len(response) > 0]
+
+        if len(responses) > 0:
+            self.responses.setdefault(trigger.lower(), []).extend(responses)
+
+    def load_sqlite(self, trigger, filename, table, column='message'):
+        try:
+            db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)  # read only, don't create missing files
+            try:
+                rows = db.execute('SELECT "%s" FROM "%s"' % (column, table)).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error as error:
+            self.log('Couldn\'t load canned responses for %s from %s: %s' % (trigger, filename, error))
+            return
+
+        self.add(trigger, [row[0] for row in rows])
+
+    def load(self, corpora):
+        """loads a list of {"trigger": ..., "file": ..., "table": ..., "column": ...} dicts from the config"""
+        for corpus in corpora:
+            self.load_sqlite(corpus['trigger'], corpus['file'], corpus['table'], corpus.get('column', 'message'))
+
+    def pick(self, trigger):
+        return random.choice(self.responses[trigger])
+
+    def stats(self):
+        return ', '.join('%s=%i' % (trigger, len(responses)) for trigger, responses in sorted(self.responses.items()))
+
@@ -0,0 +1,58 @@
+import time
+from collections import namedtuple
+from metrics import Histogram
+
+Command = namedtuple('Command', ['name', 'func', 'admin', 'channel_only'])
+
+
+class CommandContext:
+    """everything a command handler needs to know about the message that triggered it"""
+    __slots__ = ('command', 'args', 'raw_args', 'message', 'reply_target', 'source_nick', 'channel')
+
+    def __init__(self, command, args, raw_args, message, reply_target, source_nick, channel):
+        self.command = command            # lower case command name, e.g. !quote
+        self.args = args                  # whitespace separated arguments after the command
+        self.raw_args = raw_args          # everything after the command, untouched
+        self.message = message            # the whole message
+        self.reply_target = reply_target  # channel or nick to reply to
+        self.source_nick = source_nick
+        self.channel = channel            # Channel the message was sent in, None for private messages
+
+
+class CommandRegistry:
+    """
+    Explicit commands registered once with a decorator, e.g.
+
+        @commands.command('!hi')
+        def hi(self, ctx): ...
+
+    and looked up by name for every message, recording how long each command takes.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix  # messages not starting with this can never be commands
+        self.commands = {}
+        self.latency = {}
+
+    def command(self, *names, admin=False, channel_only=False):
+        def register(func):
+            for name in names:
+                self.commands[name] = Command(name, func, admin, channel_only)
+                self.latency[name] = Histogram()
+            return func
+        return register
+
+    def get(self, name):
+        return self.commands.get(name, None)
+
+    def run(self, command, bot, ctx):
+        start = time.perf_counter()
+        try:
+            command.func(bot, ctx)
+        finally:
+            self.latency[command.name].observe(time.perf_counter() - start)
+
+    def stats(self):
+        used = [(name, histogram) for name, histogram in self.latency.items() if histogram.count > 0]
+        used.sort(key=lambda entry: entry[1].total, reverse=True)  # the commands we spend the most time in first
+        return ['%s: %s' % (name, histogram.summary()) for name, histogram in used]
@@ -2,16 +2,43 @@ import sqlite3
 import re
 import random
 import json
+import time
+import log_import
 from datetime import datetime, timezone, timedelta
-from util import normalize_nick, year_to_timestamps, escape_sql_like, clamp
+from util import AliasMap, normalize_nick, year_to_timestamps, escape_sql_like, clamp
+from quote_sampler import QuoteSampler
 
 
 class Database:
-    def __init__(self, db_name, aliases=None, ignore_nicks=None):
-        self.aliases = aliases if aliases is not None else {}
+    commit_batch_size = 200  # commit buffered writes once this many have piled up
+    commit_interval = 10     # or once the oldest of them has waited this many seconds
+
+    # default storage profile, any of these can be overridden with the "database" section of the config
+    storage_profile = {
+        'journal_mode': 'wal',     # readers don't block the writer and commits append to the log instead of rewriting pages
+        'synchronous': 'normal',   # with wal, this only risks the last few commits on power loss, never corruption
+        'mmap_size': 268435456,    # 256 MB
+        'cache_size': -65536       # negative means KiB, so 64 MB
+    }
+
+    # let's hide some stuff
+    hidden_ranges = {
+        '#garachat': [(1407110400, 1410393599)]  # 2014-08-04 - 2014-09-10
+    }
+
+    def __init__(self, db_name, aliases=None, ignore_nicks=None, storage=None):
+        self.aliases = aliases if isinstance(aliases, AliasMap) else AliasMap(aliases)
         self.ignore_nicks = ignore_nicks if ignore_nicks is not None else []
+        self.storage = dict(self.storage_profile, **(storage if storage is not None else {}))
+        self.sampler = QuoteSampler()
+        self.pending_writes = 0
+        self.pending_last_seen = {}  # nick -> timestamp, written on the next flush
+        self.first_pending_write = None
+
+        # the asyncio irc engine calls in from its handler thread, but never from more than one thread at a time
+        self.db = sqlite3.connect(db_name, check_same_thread=False)
+        self._apply_storage_profile()
 
-        self.db = sqlite3.connect(db_name)
         self.db.execute('''CREATE TABLE IF NOT EXISTS channels (
             channel TEXT NOT NULL PRIMARY KEY,
             seq_id  INTEGER NOT NULL)''')
@@ -23,16 +50,25 @@ class Database:
             raw_message TEXT,
             word_count  INTEGER,
             PRIMARY KEY (channel, seq_id))''')
+        # the search index refers to quotes by id. an explicit INTEGER PRIMARY KEY keeps its value through a VACUUM,
+        # which is free to renumber the implicit rowids and would leave the index pointing at the wrong quotes
         self.db.execute('''CREATE TABLE IF NOT EXISTS quotes (
+            id      INTEGER PRIMARY KEY,
             channel TEXT NOT NULL,
             seq_id  INTEGER NOT NULL,
             time    INTEGER,
             author  TEXT,
             message TEXT,
-            PRIMARY KEY (channel, seq_id))''')
-        self.db.execute('CREATE INDEX IF NOT EXISTS idx_time    ON quotes (time)')
-        self.db.execute('CREATE INDEX IF NOT EXISTS idx_author  ON quotes (author)')
-        self.db.execute('CREATE INDEX IF NOT EXISTS idx_message ON quotes (message)')
+            UNIQUE (channel, seq_id))''')
+        self._add_quote_ids()
+
+        # every quote query filters on channel first, so the old single-column indexes only ever caused scans.
+        # dropping them here migrates older databases (the new indexes are built once, on the first start)
+        self.db.execute('DROP INDEX IF EXISTS idx_time')
+        self.db.execute('DROP INDEX IF EXISTS idx_author')
+        self.db.execute('DROP INDEX IF EXISTS idx_message')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_quotes_channel_time        ON quotes (channel, time)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_quotes_channel_author_time ON quotes (channel, author, time)')
 
         self.db.execute('''CREATE TABLE IF NOT EXISTS nicks (
             nick       TEXT NOT NULL PRIMARY KEY,
@@ -49,6 +85,145 @@ class Database:
             received_at INTEGER)''')
         self.db.execute('CREATE INDEX IF NOT EXISTS idx_to_nick  ON mail (to_nick)')
         self.db.execute('CREATE INDEX IF NOT EXISTS idx_received ON mail (received)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_from_nick ON mail (from_nick, received)')
+
+        self.seq_ids = {}  # channel -> last seq_id used, mirrors the channels table
+        self._load_seq_ids()
+
+        counts_exist = self.db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='quote_counts'").fetchone() is not None
+        self.db.execute('''CREATE TABLE IF NOT EXISTS quote_counts (
+            channel TEXT NOT NULL,
+            author  TEXT NOT NULL,
+            year    INTEGER NOT NULL,
+            count   INTEGER NOT NULL,
+            PRIMARY KEY (channel, author, year))''')
+
+        if not counts_exist:
+            self.rebuild_quote_counts()  # one-time backfill of the rollup from the existing quotes
+
+        self.search_index = self._create_search_index()
+        self.db.commit()
+
+    def _add_quote_ids(self):
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(quotes)')]
+        if 'id' in columns:
+            return
+
+        # older databases keyed quotes on (channel, seq_id) only, copy them over keeping the rowids as the new ids.
+        # the old search index used rowids without content_rowid, so it's dropped and built again from scratch
+        self.db.execute('DROP TABLE IF EXISTS quotes_fts')
+        self.db.execute('''CREATE TABLE quotes_new (
+            id      INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            seq_id  INTEGER NOT NULL,
+            time    INTEGER,
+            author  TEXT,
+            message TEXT,
+            UNIQUE (channel, seq_id))''')
+        self.db.execute('INSERT INTO quotes_new (id, channel, seq_id, time, author, message) '
+                        'SELECT rowid, channel, seq_id, time, author, message FROM quotes')
+        self.db.execute('DROP TABLE quotes')  # takes its indexes and triggers along, they're created again below
+        self.db.execute('ALTER TABLE quotes_new RENAME TO quotes')
+        self.db.commit()
+
+    def _apply_storage_profile(self):
+        for pragma in ['journal_mode', 'synchronous', 'mmap_size', 'cache_size']:
+            value = self.storage.get(pragma, None)
+            if value is not None:
+                # pragmas can't take bound parameters, so only plain words and numbers get through
+                if re.match(r'^-?\w+$', str(value)) is None:
+                    raise ValueError('bad value for %s: %s' % (pragma, value))
+                self.db.execute('PRAGMA %s=%s' % (pragma, value))
+
+    def check_query_plans(self, channel=None):
+        """
+        Run every public read query once and return the (method, query, plan) steps that scan a whole table
+        instead of using an index. An empty list means every query is served by an index.
+        """
+        if channel is None:
+            row = self.db.execute('SELECT channel FROM channels LIMIT 1').fetchone()
+            channel = row[0] if row is not None else '#channel'
+
+        year = datetime.now(timezone.utc).year
+        self.sampler.unload(channel)  # make sure the sampler's load query is part of the check
+        calls = [
+            ('random_quote', lambda: self.random_quote(channel)),
+            ('random_quote', lambda: self.random_quote(channel, 'nobody', year)),
+            ('random_quote', lambda: self.random_quote(channel, 'nobody', year, 'hello')),
+            ('quote_count', lambda: self.quote_count(channel, 'nobody', year)),
+            ('quote_count', lambda: self.quote_count(channel, None, year, 'hello')),
+            ('quote_top', lambda: self.quote_top(channel, 5, year)),
+            ('quote_top', lambda: self.quote_top(channel, 5, None, 'hello')),
+            ('quote_top_percent', lambda: self.quote_top_percent(channel, 5, year)),
+            ('quote_top_percent', lambda: self.quote_top_percent(channel, 5, None, 'hello')),
+            ('quote_context', lambda: self.quote_context(channel, 1)),
+            ('quote_by_seq_id', lambda: self.quote_by_seq_id(channel, 1)),
+            ('current_time', lambda: self.current_time('nobody')),
+            ('last_seen', lambda: self.last_seen('nobody')),
+            ('mail_outbox', lambda: self.mail_outbox('nobody')),
+            ('mail_unread_receivers', lambda: self.mail_unread_receivers()),
+        ]
+        scans = []
+
+        for method, call in calls:
+            statements = []
+            self.db.set_trace_callback(statements.append)
+            try:
+                call()
+            finally:
+                self.db.set_trace_callback(None)
+
+            for statement in statements:
+                # fts5 reads its own shadow tables internally, those aren't ours to index
+                if not statement.lstrip().upper().startswith('SELECT') or 'quotes_fts_' in statement:
+                    continue
+                for _, _, _, detail in self.db.execute('EXPLAIN QUERY PLAN %s' % statement).fetchall():
+                    # scans of virtual tables are index lookups, scans of subqueries only see rows already found
+                    if detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail \
+                            and '(subquery' not in detail and 'CONSTANT ROW' not in detail:
+                        scans.append((method, statement, detail))
+
+        return scans
+
+    def rebuild_quote_counts(self):
+        # hidden quotes are left out of the rollup entirely, so it needs a rebuild if hidden_ranges changes
+        self.db.execute('DELETE FROM quote_counts')
+
+        for (channel,) in self.db.execute('SELECT DISTINCT channel FROM quotes').fetchall():
+            where, params = self._build_quote_where(channel)
+            self.db.execute('INSERT INTO quote_counts (channel, author, year, count) '
+                            'SELECT channel, author, CAST(strftime(\'%%Y\', time, \'unixepoch\') AS INTEGER) AS year, COUNT(*) '
+                            'FROM quotes WHERE %s GROUP BY author, year' % where, params)
+
+        self.db.commit()
+
+    def _create_search_index(self):
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='quotes_fts'").fetchone() is not None
+
+        try:
+            # trigram tokens let the index answer arbitrary substring searches, not just whole words
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5 (message, content='quotes', content_rowid='id', tokenize='trigram')")
+        except sqlite3.OperationalError:
+            return False  # sqlite was built without fts5 or is too old for trigrams, so searches fall back to LIKE scans
+
+        self._create_search_triggers()
+
+        if not exists:
+            self.rebuild_search_index()  # one-time backfill of quotes that were added before the index existed
+
+        return True
+
+    def _create_search_triggers(self):
+        self.db.execute('''CREATE TRIGGER IF NOT EXISTS quotes_fts_insert AFTER INSERT ON quotes BEGIN
+            INSERT INTO quotes_fts (rowid, message) VALUES (new.id, new.message);
+            END''')
+        self.db.execute('''CREATE TRIGGER IF NOT EXISTS quotes_fts_delete AFTER DELETE ON quotes BEGIN
+            INSERT INTO quotes_fts (quotes_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            END''')
+
+    def rebuild_search_index(self):
+        # only needed for the first backfill or if the index ever got out of sync, ids survive a VACUUM
+        self.db.execute("INSERT INTO quotes_fts (quotes_fts) VALUES ('rebuild')")
         self.db.commit()
 
     def _build_quote_where(self, channel, author=None, year=None, word=None):
@@ -68,18 +243,68 @@ class Database:
             params += (author,)
 
         if word is not None:
+            # trigram matches are a case-folded superset of the LIKE matches, so the index narrows the rows down
+            # and LIKE keeps the exact semantics. shorter words have no trigrams and can only be scanned
+            # the unary + keeps the planner from preferring a walk over the whole channel to the id lookups
+            if self.search_index and len(word) >= 3:
+                query = '+' + query + ' AND id IN (SELECT rowid FROM quotes_fts WHERE quotes_fts MATCH ?)'
+                params += ('"%s"' % word.replace('"', '""'),)
+
             word = escape_sql_like(word.lower())
             query += ' AND message LIKE ? ESCAPE ?'
             params += ('%' + word + '%', '\\')
 
-        # let's hide some stuff
-        if channel == '#garachat':
+        for hidden_range in self.hidden_ranges.get(channel, []):
             query += ' AND time NOT BETWEEN ? AND ?'
-            params += (1407110400, 1410393599)  # 2014-08-04 - 2014-09-10
+            params += hidden_range
 
         return query, params
 
-    def add_quote(self, channel, timestamp, author, message, commit=True, full_only=False):
+    def _build_count_where(self, channel, author=None, year=None):
+        query = 'channel=?'
+        params = (channel,)
+
+        if year is not None:
+            if year_to_timestamps(year) is None:
+                return None
+            query += ' AND year=?'
+            params += (year,)
+
+        if author is not None:
+            author = normalize_nick(author, self.aliases)
+            query += ' AND author=?'
+            params += (author,)
+
+        return query, params
+
+    def _is_hidden(self, channel, timestamp):
+        return any(time_min <= timestamp <= time_max for time_min, time_max in self.hidden_ranges.get(channel, []))
+
+    def _count_quotes(self, channel, quotes):
+        counts = {}
+        for timestamp, author in quotes:
+            if not self._is_hidden(channel, timestamp):
+                key = (author, time.gmtime(timestamp).tm_year)
+                counts[key] = counts.get(key, 0) + 1
+
+        self.db.executemany('INSERT OR IGNORE INTO quote_counts (channel, author, year, count) VALUES (?, ?, ?, ?)',
+                            [(channel, author, year, 0) for author, year in counts])
+        self.db.executemany('UPDATE quote_counts SET count=count+? WHERE channel=? AND author=? AND year=?',
+                            [(count, channel, author, year) for (author, year), count in counts.items()])
+
+    def _load_seq_ids(self):
+        self.seq_ids = dict(self.db.execute('SELECT channel, seq_id FROM channels').fetchall())
+
+    def _allocate_seq_ids(self, channel, count):
+        # returns the first of count new consecutive ids; the id stored in the sequence table will always be the last one used.
+        # the counter lives in memory, but is written in the same transaction as the quotes that use it
+        first_seq_id = self.seq_ids.get(channel, 0) + 1
+        last_seq_id = first_seq_id + count - 1
+        self.db.execute('INSERT OR REPLACE INTO channels (channel, seq_id) VALUES (?, ?)', (channel, last_seq_id))
+        self.seq_ids[channel] = last_seq_id
+        return first_seq_id
+
+    def _prepare_quote(self, timestamp, author, message, full_only):
         raw_author = author
         raw_message = message
         author = normalize_nick(author, self.aliases)
@@ -87,26 +312,96 @@ class Database:
         word_count = len(message.split())
 
         if timestamp == 0 or len(author) == 0:
-            return False
+            return None
 
-        self.db.execute('INSERT OR IGNORE INTO channels (channel, seq_id) VALUES (?, ?)', (channel, 0))
-        seq_id, = self.db.execute('SELECT seq_id FROM channels WHERE channel=?', (channel,)).fetchone()
-        seq_id += 1  # increment by 1; the id stored in the sequence table will always be the last one used
+        # if the message is long enough, wasn't made by an ignored nick, and wasn't an explicit command, add it to the fast table
+        fast = word_count >= 5 and author not in self.ignore_nicks and not full_only
+        return timestamp, raw_author, raw_message, word_count, author, message, fast
+
+    def add_quote(self, channel, timestamp, author, message, commit=True, full_only=False):
+        quote = self._prepare_quote(timestamp, author, message, full_only)
+
+        if quote is None:
+            return False
 
-        self.db.execute('UPDATE channels SET seq_id=? WHERE channel=?', (seq_id, channel))
+        timestamp, raw_author, raw_message, word_count, author, message, fast = quote
+        seq_id = self._allocate_seq_ids(channel, 1)
         self.db.execute('INSERT INTO quotes_full (channel, seq_id, time, raw_author, raw_message, word_count) VALUES (?, ?, ?, ?, ?, ?)',
                         (channel, seq_id, timestamp, raw_author, raw_message, word_count))
 
-        # if the message is long enough, wasn't made by an ignored nick, and wasn't an explicit command, add it to the fast table
-        if word_count >= 5 and author not in self.ignore_nicks and not full_only:
+        if fast:
             self.db.execute('INSERT INTO quotes (channel, seq_id, time, author, message) VALUES (?, ?, ?, ?, ?)',
                             (channel, seq_id, timestamp, author, message))
+            self._count_quotes(channel, [(timestamp, author)])
+            self.sampler.add(channel, timestamp, author, seq_id)
 
         if commit:
-            self.db.commit()
+            self._write_behind()
 
         return True  # return true if the quote was added
 
+    def import_quotes(self, channel, rows, batch_size=20000):
+        """
+        Bulk version of add_quote for (timestamp, author, message) rows, e.g. from the log_import parsers.
+        Everything is inserted in a single transaction, with seq_ids allocated a batch at a time.
+        """
+        imported = 0
+        skipped = 0
+        batch = []
+        self.flush()
+
+        if self.search_index:
+            # indexing all new rows with one statement at the end is much cheaper than firing the trigger for each of them
+            last_id, = self.db.execute('SELECT COALESCE(MAX(id), 0) FROM quotes').fetchone()
+            self.db.execute('DROP TRIGGER IF EXISTS quotes_fts_insert')
+
+        def insert_batch():
+            seq_id = self._allocate_seq_ids(channel, len(batch))
+            full_rows = []
+            fast_rows = []
+
+            for timestamp, raw_author, raw_message, word_count, author, message, fast in batch:
+                full_rows.append((channel, seq_id, timestamp, raw_author, raw_message, word_count))
+                if fast:
+                    fast_rows.append((channel, seq_id, timestamp, author, message))
+                seq_id += 1
+
+            self.db.executemany('INSERT INTO quotes_full (channel, seq_id, time, raw_author, raw_message, word_count) VALUES (?, ?, ?, ?, ?, ?)', full_rows)
+            self.db.executemany('INSERT INTO quotes (channel, seq_id, time, author, message) VALUES (?, ?, ?, ?, ?)', fast_rows)
+            self._count_quotes(channel, [(timestamp, author) for _, _, timestamp, author, _ in fast_rows])
+            batch.clear()
+
+        try:
+            for timestamp, author, message in rows:
+                quote = self._prepare_quote(timestamp, author, message, False)
+
+                if quote is None:
+                    skipped += 1
+                    continue
+
+                batch.append(quote)
+                imported += 1
+
+                if len(batch) >= batch_size:
+                    insert_batch()
+
+            if len(batch) > 0:
+                insert_batch()
+
+            if self.search_index:
+                self.db.execute('INSERT INTO quotes_fts (rowid, message) SELECT id, message FROM quotes WHERE id>?', (last_id,))
+        except:
+            self.db.rollback()
+            self._load_seq_ids()  # the ids handed out to the rolled back rows are free again
+            raise
+        finally:
+            self.sampler.unload(channel)  # reloaded from the database on next use
+            if self.search_index:
+                self._create_search_triggers()
+
+        self.db.commit()
+        return imported, skipped
+
     def quote_context(self, channel, seq_id, lines=20):
         rows = self.db.execute('SELECT time, raw_author, raw_message FROM quotes_full WHERE channel=? AND seq_id BETWEEN ? AND ? ORDER BY seq_id ASC',
                                (channel, seq_id - lines, seq_id + lines)).fetchall()
@@ -129,18 +424,45 @@ class Database:
 
         return '%s -- %s, %s (%i)' % (message, normalize_nick(author, self.aliases), date, seq_id)
 
-    def random_quote(self, channel, author=None, year=None, word=None, stringify=True):
-        num_rows = self.quote_count(channel, author, year, word)
+    def _load_sampler(self, channel):
+        if not self.sampler.is_loaded(channel):
+            rows = self.db.execute('SELECT time, seq_id, author FROM quotes WHERE channel=? ORDER BY time, seq_id', (channel,))
+            self.sampler.load(channel, rows)
 
-        if num_rows == 0:
+    def _sample_quote(self, channel, author=None, year=None):
+        time_tuple = year_to_timestamps(year)
+
+        if time_tuple is None:
             return None
 
-        random_skip = random.randint(0, num_rows - 1)
-        where, params = self._build_quote_where(channel, author, year, word)
-        query = 'SELECT seq_id, time, author, message FROM quotes WHERE %s LIMIT 1 OFFSET %i' % (where, random_skip)
+        if author is not None:
+            author = normalize_nick(author, self.aliases)
 
-        cursor = self.db.cursor()
-        cursor.execute(query, params)
+        self._load_sampler(channel)
+        time_min, time_max = time_tuple
+        return self.sampler.pick(channel, author, time_min, time_max, self.hidden_ranges.get(channel, []))
+
+    def random_quote(self, channel, author=None, year=None, word=None, stringify=True):
+        if word is None:
+            # unfiltered, author and year picks are served by the in-memory sampler without scanning the table
+            seq_id = self._sample_quote(channel, author, year)
+
+            if seq_id is None:
+                return None
+
+            cursor = self.db.execute('SELECT seq_id, time, author, message FROM quotes WHERE channel=? AND seq_id=?', (channel, seq_id))
+        else:
+            num_rows = self.quote_count(channel, author, year, word)
+
+            if num_rows == 0:
+                return None
+
+            random_skip = random.randint(0, num_rows - 1)
+            where, params = self._build_quote_where(channel, author, year, word)
+            query = 'SELECT seq_id, time, author, message FROM quotes WHERE %s LIMIT 1 OFFSET %i' % (where, random_skip)
+
+            cursor = self.db.cursor()
+            cursor.execute(query, params)
 
         (seq_id, timestamp, author, message) = cursor.fetchone()
         date = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%b %d %Y')
@@ -150,8 +472,17 @@ class Database:
         return '%s -- %s, %s (%i)' % parts if stringify else parts
 
     def quote_count(self, channel, author=None, year=None, word=None):
-        where, params = self._build_quote_where(channel, author, year, word)
-        query = 'SELECT COUNT(*) FROM quotes WHERE %s' % where
+        if word is None:
+            where = self._build_count_where(channel, author, year)
+
+            if where is None:
+                return 0
+
+            where, params = where
+            query = 'SELECT COALESCE(SUM(count), 0) FROM quote_counts WHERE %s' % where
+        else:
+            where, params = self._build_quote_where(channel, author, year, word)
+            query = 'SELECT COUNT(*) FROM quotes WHERE %s' % where
 
         cursor = self.db.cursor()
         cursor.execute(query, params)
@@ -160,30 +491,50 @@ class Database:
         return int(count)
 
     def quote_top(self, channel, size=5, year=None, word=None):
-        where, params = self._build_quote_where(channel, None, year, word)
-        query = 'SELECT author, COUNT(*) AS c FROM quotes WHERE %s ' \
-                'GROUP BY author HAVING c>0 ORDER BY c DESC LIMIT %i' % (where, size)
+        if word is None:
+            where = self._build_count_where(channel, None, year)
+
+            if where is None:
+                return []
+
+            where, params = where
+            query = 'SELECT author, SUM(count) AS c FROM quote_counts WHERE %s ' \
+                    'GROUP BY author HAVING c>0 ORDER BY c DESC LIMIT %i' % (where, size)
+        else:
+            where, params = self._build_quote_where(channel, None, year, word)
+            query = 'SELECT author, COUNT(*) AS c FROM quotes WHERE %s ' \
+                    'GROUP BY author HAVING c>0 ORDER BY c DESC LIMIT %i' % (where, size)
 
         cursor = self.db.cursor()
         cursor.execute(query, params)
         return ['%s: %i quotes' % (a, c) for a, c in cursor.fetchall()]
 
     def quote_top_percent(self, channel, size=5, year=None, word=None):
-        where, params = self._build_quote_where(channel, None, year, word)
-        where_total, params_total = self._build_quote_where(channel)
+        # totals always come from the rollup, only a search needs to count the matching quote rows themselves
+        if word is None:
+            where = self._build_count_where(channel, None, year)
+
+            if where is None:
+                return []
+
+            where, params = where
+            matching_query = 'SELECT author, SUM(count) AS matching FROM quote_counts WHERE %s GROUP BY author' % where
+        else:
+            where, params = self._build_quote_where(channel, None, year, word)
+            matching_query = 'SELECT author, COUNT(*) AS matching FROM quotes WHERE %s GROUP BY author' % where
+
         query = 'SELECT author, matching, total, ' \
                 'CAST(matching AS REAL) / total * 100 AS ratio ' \
-                'FROM (' \
-                '  SELECT author, ' \
-                '  SUM(CASE WHEN %s THEN 1 ELSE 0 END) AS matching, ' \
-                '  SUM(CASE WHEN %s THEN 1 ELSE 0 END) AS total ' \
-                '  FROM quotes GROUP BY author ' \
-                '  HAVING matching>0 AND total>0 AND total>=500' \
-                ') ' \
-                'ORDER BY ratio DESC LIMIT %i' % (where, where_total, size)
+                'FROM (%s) ' \
+                'JOIN (' \
+                '  SELECT author, SUM(count) AS total FROM quote_counts WHERE channel=? ' \
+                '  GROUP BY author HAVING total>=500' \
+                ') USING (author) ' \
+                'WHERE matching>0 ' \
+                'ORDER BY ratio DESC LIMIT %i' % (matching_query, size)
 
         cursor = self.db.cursor()
-        cursor.execute(query, params + params_total)
+        cursor.execute(query, params + (channel,))
         return ['%s: %g%% (%i/%i)' % (a, r, c, t) for a, c, t, r in cursor.fetchall()]
 
     def set_current_time(self, nick, utc_offset):
@@ -196,7 +547,7 @@ class Database:
         cursor = self.db.cursor()
         cursor.execute('INSERT OR IGNORE INTO nicks (nick) VALUES (?)', (nick,))
         cursor.execute('UPDATE nicks SET utc_offset=? WHERE nick=?', (utc_offset, nick))
-        self.db.commit()
+        self.flush()
 
         return 'ok :)'
 
@@ -218,16 +569,18 @@ class Database:
     def update_last_seen(self, nick, timestamp=None):
         nick = normalize_nick(nick, self.aliases)
         timestamp = timestamp if timestamp is not None else int(datetime.now(timezone.utc).timestamp())
-        cursor = self.db.cursor()
-        cursor.execute('INSERT OR IGNORE INTO nicks (nick) VALUES (?)', (nick,))
-        cursor.execute('UPDATE nicks SET last_seen=? WHERE nick=?', (timestamp, nick))
-        self.db.commit()
+        self.pending_last_seen[nick] = timestamp  # repeated lines from the same nick collapse into a single write
+        self._write_behind()
 
     def last_seen(self, nick):
         alias = normalize_nick(nick, self.aliases)
-        cursor = self.db.cursor()
-        cursor.execute('SELECT last_seen FROM nicks WHERE nick=?', (alias,))
-        row = cursor.fetchone()
+
+        if alias in self.pending_last_seen:
+            row = (self.pending_last_seen[alias],)  # seen since the last flush
+        else:
+            cursor = self.db.cursor()
+            cursor.execute('SELECT last_seen FROM nicks WHERE nick=?', (alias,))
+            row = cursor.fetchone()
 
         if row is None or row[0] is None:
             return '%s has never been seen :(' % nick
@@ -240,12 +593,12 @@ class Database:
         cursor = self.db.cursor()
         cursor.execute('INSERT INTO mail (from_nick, to_nick, message, received, sent_at, received_at) VALUES (?, ?, ?, ?, ?, ?)',
                        (from_, to, message, False, int(datetime.now(timezone.utc).timestamp()), None))
-        self.db.commit()
+        self.flush()
 
     def mail_unsend(self, from_, id):
         cursor = self.db.cursor()
         cursor.execute('DELETE FROM mail WHERE from_nick=? AND id=?', (from_, id))
-        self.db.commit()
+        self.flush()
         return cursor.rowcount > 0
 
     def mail_outbox(self, from_):
@@ -264,7 +617,7 @@ class Database:
 
         now = int(datetime.now(timezone.utc).timestamp())
         cursor.execute('UPDATE mail SET received=?, received_at=? WHERE to_nick=? AND received=?', (True, now, to, False))
-        self.db.commit()
+        self.flush()
 
         return messages
 
@@ -273,106 +626,18 @@ class Database:
         cursor.execute('SELECT DISTINCT to_nick FROM mail WHERE received=?', (False,))
         return [nick for (nick,) in cursor.fetchall()]
 
-    def import_irssi_log(self, filename, channel, utc_offset=0):
-        utc_offset_padded = ('+' if utc_offset >= 0 else '') + str(utc_offset).zfill(2 if utc_offset >= 0 else 3) + '00'
-        lines = 0
-        messages = 0
-        imported = 0
-        skipped = 0
-        log_date = datetime.fromtimestamp(0, timezone.utc)
-
-        with open(filename, 'r', encoding='utf-8') as log:
-            for line in log:
-                lines += 1
-
-                if lines % 20000 == 0:
-                    self.db.commit()  # commit every 20000 lines for performance
-                    print('processing line %i' % lines)
-
-                line = line.strip()
-                date_match = re.match(r'^--- Day changed .{3} (\w{3}) (\d{2}) (\d{4})$', line)
-                date_match2 = re.match(r'^--- Log opened .{3} (\w{3}) (\d{2}) .{8} (\d{4})$', line)
-                date_match = date_match if date_match is not None else date_match2
-
-                if date_match is not None:
-                    date_str = '%s %s %s %s' % (date_match.group(1), date_match.group(2), date_match.group(3), utc_offset_padded)
-                    log_date = datetime.strptime(date_str, '%b %d %Y %z')
-                    continue
-
-                match = re.match(r'^(\d\d):(\d\d)\s<(.+?)>\s(.+)$', line)  # 12:34 <&author> message
-
-                if match is None:
-                    continue
-
-                messages += 1
-                log_time = log_date.replace(hour=int(match.group(1)), minute=int(match.group(2)))
-                timestamp = int(log_time.astimezone(timezone.utc).timestamp())
-                author = match.group(3)
-                message = match.group(4)
-
-                if self.add_quote(channel, timestamp, author, message, False):
-                    imported += 1
-                else:
-                    skipped += 1
-
-        self.db.commit()  # do a final commit if some insertions were left over
-        print('Imported %i messages' % imported)
-        print('Skipped %i messages' % skipped)
-        print('%i messages total' % messages)
-        print('%i lines total' % lines)
-
-    def import_hexchat_log(self, filename, channel, utc_offset=0):
-        utc_offset_padded = ('+' if utc_offset >= 0 else '') + str(utc_offset).zfill(2 if utc_offset >= 0 else 3) + '00'
-        lines = 0
-        messages = 0
-        imported = 0
-        skipped = 0
-        year = 1970
-
-        with open(filename, 'r', encoding='utf-8') as log:
-            for line in log:
-                lines += 1
-
-                if lines % 20000 == 0:
-                    self.db.commit()  # commit every 20000 lines for performance
-                    print('processing line %i' % lines)
-
-                line = line.strip()
-                year_match = re.match(r'^\*\*\*\* BEGIN LOGGING AT .* (\d{4})$', line)
-
-                if year_match is not None:
-                    year = int(year_match.group(1))
-                    continue
-
-                match = re.match(r'^(.{15})\s<(.+?)>\s(.+)$', line)  # jan 01 12:34:56 <author> message
-
-                if match is None:
-                    continue
-
-                messages += 1
-                log_time_tz = '%s %i %s' % (match.group(1), year, utc_offset_padded)
-                log_time = datetime.strptime(log_time_tz, '%b %d %X %Y %z')
-                timestamp = int(log_time.astimezone(timezone.utc).timestamp())
-                author = match.group(2)
-                message = match.group(3)
+    def import_irssi_log(self, filename, channel, utc_offset=0, processes=1):
+        return log_import.import_log(self, filename, channel, 'irssi', utc_offset, processes)
 
-                if self.add_quote(channel, timestamp, author, message, False):
-                    imported += 1
-                else:
-                    skipped += 1
-
-        self.db.commit()  # do a final commit if some insertions were left over
-        print('Imported %i messages' % imported)
-        print('Skipped %i messages' % skipped)
-        print('%i messages total' % messages)
-        print('%i lines total' % lines)
+    def import_hexchat_log(self, filename, channel, utc_offset=0, processes=1):
+        return log_import.import_log(self, filename, channel, 'hexchat', utc_offset, processes)
 
     def dump_irssi_log_authors(self, filename):
         authors = {}
 
         with open(filename, 'r', encoding='utf-8') as log:
             for line in log:
-                match = re.match(r'^(\d\d):(\d\d)\s<(.+?)>\s(.+)$', line)
+                match = log_import.irssi_message.match(line)
 
                 if match is None:
                     continue
@@ -385,7 +650,36 @@ class Database:
 
         return authors
 
+    def _write_behind(self):
+        # group commit: every write goes to the connection right away, so reads on it already see them
+        # (!quoteid, !seen), but the commit and its fsync are shared by a whole batch of writes
+        self.pending_writes += 1
+
+        if self.first_pending_write is None:
+            self.first_pending_write = time.time()
+
+        if self.pending_writes >= self.commit_batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.first_pending_write is not None and time.time() - self.first_pending_write >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending_last_seen) > 0:
+            nicks = list(self.pending_last_seen.items())
+            self.db.executemany('INSERT OR IGNORE INTO nicks (nick) VALUES (?)', [(nick,) for nick, _ in nicks])
+            self.db.executemany('UPDATE nicks SET last_seen=? WHERE nick=?', [(timestamp, nick) for nick, timestamp in nicks])
+            self.pending_last_seen = {}
+
+        self.db.commit()
+        self.pending_writes = 0
+        self.first_pending_write = None
+
     def close(self):
+        self.flush()
         self.db.close()
 
 
@@ -397,7 +691,7 @@ if __name__ == '__main__':
         #     if nick not in q.aliases.keys():
         #         print('%s %i' % (nick, msg_count))
         # q.add_quote('#garachat', 0, 'ashin', '( ͡° ͜ʖ ͡°)')
-        # q.import_irssi_log('gclogs/#garachat-master.log', '#garachat', 0)
+        # q.import_irssi_log('gclogs/#garachat-master.log', '#garachat', 0, processes=4)
         print(q.quote_top(channel='#garachat', size=5))
         print(q.random_quote(channel='#garachat', author='ashin', year=2010))
         print(q.quote_count(channel='#garachat', author='sarah'))
@@ -405,5 +699,6 @@ if __name__ == '__main__':
         print(q.quote_top_percent(channel='#garachat', year=None, word='cup'))
         print(q.quote_context(channel='#garachat', seq_id=183047))
         print(q.quote_by_seq_id(channel='#garachat', seq_id=183047))
+        print(q.check_query_plans(channel='#garachat'))
 
         q.close()
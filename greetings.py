@@ -1,10 +1,21 @@
 import time
 import json
+import heapq
 import os.path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class Greeting:
+    # the fields that stay fixed for each kind of repeat, everything coarser comes from the current period
+    fixed_fields = {
+        'yearly': ('month', 'day', 'hour', 'minute', 'second'),
+        'monthly': ('day', 'hour', 'minute', 'second'),
+        'daily': ('hour', 'minute', 'second'),
+        'hourly': ('minute', 'second'),
+        'minutely': ('second',)
+    }
+    max_skipped_periods = 8  # e.g. feb 29 only exists every 4 years, so look that far ahead for the next occurrence
+
     def __init__(self, channel, dt, repeat, message, last_used):
         self.channel = channel
         self.repeat = repeat
@@ -17,33 +28,59 @@ class Greeting:
                                    minute=dt.minute,
                                    second=dt.second)
 
+    @property
+    def key(self):
+        return '%s %s %s %s' % (self.channel, self.greet_time.strftime(date_format), self.repeat, self.message)
+
     def matches(self, now):
-        # make a copy of the timestamps with the variable/repeatable parts swapped out with the current time
-        # last used time needs to be compared using the variable parts too
-        # (otherwise any event from earlier in the year will trigger: a last_used 0001-01-01 00:00:00
-        # < yearly 2016-01-01 (= not already used), but 2016-01-01 00:00:00 >= 2016-01-01 00:00:00 (= already used))
-        time_cmp = self.greet_time
-        used_cmp = self.last_used
-
-        if self.repeat in ['yearly', 'monthly', 'daily', 'hourly', 'minutely']:
-            time_cmp = time_cmp.replace(year=now.year)
-            used_cmp = used_cmp.replace(year=now.year)
-        if self.repeat in ['monthly', 'daily', 'hourly', 'minutely']:
-            time_cmp = time_cmp.replace(month=now.month)
-            used_cmp = used_cmp.replace(month=now.month)
-        if self.repeat in ['daily', 'hourly', 'minutely']:
-            time_cmp = time_cmp.replace(day=now.day)
-            used_cmp = used_cmp.replace(day=now.day)
-        if self.repeat in ['hourly', 'minutely']:
-            time_cmp = time_cmp.replace(hour=now.hour)
-            used_cmp = used_cmp.replace(hour=now.hour)
-        if self.repeat in ['minutely']:
-            time_cmp = time_cmp.replace(minute=now.minute)
-            used_cmp = used_cmp.replace(minute=now.minute)
-
-        passed = now >= time_cmp
-        already_used = used_cmp >= time_cmp
-        return passed and not already_used
+        # due if this period's occurrence has passed and hasn't been used yet, occurrences from earlier periods are
+        # never made up for (no christmas greeting in march because the bot was offline on christmas eve)
+        occurrence = self.current_occurrence(now)
+        return occurrence is not None and occurrence <= now and self.last_used < occurrence
+
+    def next_fire_time(self, now):
+        """when matches() becomes true, now if it already is, None if it never will again"""
+        if self.matches(now):
+            return now
+        return self.next_occurrence(now)
+
+    def current_occurrence(self, now):
+        """the occurrence in the same year/month/day/... as now, None if there is none (e.g. the 31st in april)"""
+        if self.repeat not in self.fixed_fields:
+            return self.greet_time
+        return self._occurrence(self._period_start(now))
+
+    def next_occurrence(self, now):
+        """the earliest occurrence after now"""
+        if self.repeat not in self.fixed_fields:
+            return self.greet_time if self.greet_time > now else None
+
+        period = self._period_start(now)
+        for _ in range(self.max_skipped_periods):
+            occurrence = self._occurrence(period)
+            if occurrence is not None and occurrence > now:
+                return occurrence
+            period = self._shift(period, 1)
+        return None
+
+    def _period_start(self, dt):
+        fixed = {field: 1 if field in ('month', 'day') else 0 for field in self.fixed_fields[self.repeat]}
+        return dt.replace(microsecond=0, **fixed)
+
+    def _shift(self, period, periods):
+        if self.repeat == 'yearly':
+            return period.replace(year=period.year + periods)
+        if self.repeat == 'monthly':
+            months = period.year * 12 + period.month - 1 + periods
+            return period.replace(year=months // 12, month=months % 12 + 1)
+        unit = {'daily': 'days', 'hourly': 'hours', 'minutely': 'minutes'}[self.repeat]
+        return period + timedelta(**{unit: periods})
+
+    def _occurrence(self, period):
+        try:
+            return period.replace(**{field: getattr(self.greet_time, field) for field in self.fixed_fields[self.repeat]})
+        except ValueError:
+            return None  # the day doesn't exist in this period, e.g. the 31st in april
 
     def as_json(self):
         return {
@@ -56,45 +93,129 @@ class Greeting:
 
 
 conf_file = 'greetings.conf'
+journal_file = 'greetings.journal'
 date_format = '%Y-%m-%d %H:%M:%S'
 
 
-def greet():
-    greetings = reload()
-    now = datetime.utcnow()
-    matched = []
-
-    for greeting in greetings:
-        if greeting.matches(now):
-            greeting.last_used = now
-            matched.append((greeting.channel, greeting.message))
-
-    if len(matched) > 0:
-        with open(conf_file, 'w') as f:
-            json.dump([g.as_json() for g in greetings], f, indent=2, separators=(',', ': '), sort_keys=True)
-
-    return matched
-
-
-def reload():
-    greetings = []
-    if os.path.exists(conf_file):
-        with open(conf_file) as f:
-            for json_greeting in json.load(f):
-                channel = json_greeting['channel']
-                dt = datetime.strptime(json_greeting['date'], date_format)
-                repeat = json_greeting['repeat'].lower()
-                message = json_greeting['message']
-                last_used = json_greeting.get('last_used', None)
-
-                if last_used is not None:
-                    last_used = datetime.strptime(last_used, date_format)
-
-                greetings.append(Greeting(channel, dt, repeat, message, last_used))
-    return greetings
+class GreetingSchedule:
+    """
+    Greetings in a heap ordered by when they fire next, so checking whether one is due only looks at the top entry.
+    greetings.conf is parsed again only after its mtime changes, and the time each greeting was last used is
+    appended to a journal instead of rewriting the conf file (the last_used in the conf file is only a default).
+    """
+    compact_after = 1000  # journal lines before the journal is rewritten with one line per greeting
+
+    def __init__(self, conf_file=conf_file, journal_file=journal_file, log=None):
+        self.conf_file = conf_file
+        self.journal_file = journal_file
+        self.log = log if log is not None else print
+        self.mtime = None
+        self.heap = []  # (next fire time, index, greeting)
+        self.greetings = []
+
+    def __len__(self):
+        return len(self.greetings)
+
+    def greet(self, now=None):
+        """the (channel, message) pairs that are due, each is marked as used"""
+        now = now if now is not None else datetime.utcnow()
+        self.reload_if_changed()
+        matched = []
+        used = []
+
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            _, index, greeting = heapq.heappop(self.heap)
+
+            if greeting.matches(now):
+                greeting.last_used = now
+                matched.append((greeting.channel, greeting.message))
+                used.append(greeting)
+
+            self._push(index, greeting, now)
+
+        if len(used) > 0:
+            with open(self.journal_file, 'a') as f:
+                for greeting in used:
+                    f.write(json.dumps({'key': greeting.key, 'last_used': now.strftime(date_format)}) + '\n')
+
+        return matched
+
+    def seconds_until_next(self, now=None):
+        """seconds until the next greeting fires, None if none ever will"""
+        now = now if now is not None else datetime.utcnow()
+        if len(self.heap) == 0:
+            return None
+        return max((self.heap[0][0] - now).total_seconds(), 0)
+
+    def reload_if_changed(self):
+        mtime = os.path.getmtime(self.conf_file) if os.path.exists(self.conf_file) else None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            try:
+                self.reload()
+            except (OSError, ValueError, KeyError) as error:
+                # keep the greetings we had until the file is fixed
+                self.log('Couldn\'t load %s (%s): %s' % (self.conf_file, str(type(error)), error.args))
+
+    def reload(self):
+        greetings = []
+        if os.path.exists(self.conf_file):
+            with open(self.conf_file) as f:
+                for json_greeting in json.load(f):
+                    channel = json_greeting['channel']
+                    dt = datetime.strptime(json_greeting['date'], date_format)
+                    repeat = json_greeting['repeat'].lower()
+                    message = json_greeting['message']
+                    last_used = json_greeting.get('last_used', None)
+
+                    if last_used is not None:
+                        last_used = datetime.strptime(last_used, date_format)
+
+                    greetings.append(Greeting(channel, dt, repeat, message, last_used))
+
+        journal = self._read_journal()
+        for greeting in greetings:
+            if greeting.key in journal:
+                greeting.last_used = max(greeting.last_used, journal[greeting.key])
+
+        now = datetime.utcnow()
+        self.greetings = greetings
+        self.heap = []
+        for index, greeting in enumerate(greetings):
+            self._push(index, greeting, now)
+
+    def _push(self, index, greeting, now):
+        fire_time = greeting.next_fire_time(now)
+        if fire_time is not None:  # one-off greetings that have been used drop out of the heap
+            heapq.heappush(self.heap, (fire_time, index, greeting))
+
+    def _read_journal(self):
+        last_used = {}  # key => latest use
+        lines = 0
+
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        used = datetime.strptime(entry['last_used'], date_format)
+                    except (ValueError, KeyError):
+                        continue  # e.g. a half written line from a crash
+                    last_used[entry['key']] = max(used, last_used.get(entry['key'], used))
+
+        if lines > self.compact_after:
+            temp_file = self.journal_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                for key, used in last_used.items():
+                    f.write(json.dumps({'key': key, 'last_used': used.strftime(date_format)}) + '\n')
+            os.replace(temp_file, self.journal_file)
+
+        return last_used
 
 
 if __name__ == '__main__':
+    schedule = GreetingSchedule()
     while True:
-        print(datetime.utcnow(), greet())
+        print(datetime.utcnow(), schedule.greet(), schedule.seconds_until_next())
         time.sleep(10)
@@ -0,0 +1,54 @@
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """
+    All http requests the bot makes go through one of these, so connections to the same host are kept alive and reused
+    instead of doing a new TCP + TLS handshake for every request. Pass a different instance (or anything with the same
+    get/head/post methods) to LinkGenerator and LinkLookup to point them somewhere else, e.g. a local test server.
+    """
+    timeout = 5           # used when the caller doesn't pass one
+    pool_connections = 8  # number of hosts to keep a connection pool for
+    pool_maxsize = 8      # connections kept per host, should be at least the number of work pool threads
+    retries = 2           # for connection errors and 502/503/504 responses, never for 4xx
+    backoff_factor = 0.3  # seconds, doubled for every retry after the first
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, retries=None, backoff_factor=None):
+        retry = Retry(
+            total=retries if retries is not None else self.retries,
+            backoff_factor=backoff_factor if backoff_factor is not None else self.backoff_factor,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(['HEAD', 'GET']),  # a retried POST could paste or tweet twice
+            raise_on_status=False,
+            respect_retry_after_header=False  # the bot would rather give up than sleep for minutes
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections if pool_connections is not None else self.pool_connections,
+            pool_maxsize=pool_maxsize if pool_maxsize is not None else self.pool_maxsize,
+            max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))  # stay stateless like plain requests.get
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)  # same as requests.head, the link generators read the Location
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def close(self):
+        self.session.close()
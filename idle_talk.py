@@ -1,6 +1,7 @@
 import random
 import time
 import os.path
+from log_writer import LogWriter
 
 
 class IdleTalk:
@@ -29,8 +30,7 @@ class IdleTalk:
         self.last_message = time.time()
         self.delay = self._random_delay()  # set a random delay for each "quiet period"
 
-        with open(self.log_file, 'a', encoding='utf-8') as file:
-            file.write('%s\r\n' % msg)
+        self.log_writer.write(msg)
 
         self._trim_log()
 
@@ -59,6 +59,10 @@ class IdleTalk:
                 self.log = file.readlines()
 
         self._trim_log()
+        self.log_writer = LogWriter(self.log_file)  # appends from a background thread, closed at exit at the latest
+
+    def close(self):
+        self.log_writer.close()
 
 
 class IdleTimer:
@@ -85,6 +89,9 @@ class IdleTimer:
         t = time.time()
         return self.last_receive + self.delay < t and self.last_send + self.interval < t
 
+    def seconds_until_talk(self):
+        return max(self.last_receive + self.delay, self.last_send + self.interval) - time.time()
+
     def __init__(self):
         self.last_receive = 0
         self.last_send = 0
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+import sys
 import socket
 import select
 import time
+import threading
 import traceback
 from datetime import datetime
 from util import is_channel
+from send_queue import SendQueue
+from line_buffer import LineBuffer
+from irc_message import Message
+from scheduler import Scheduler
+from log_writer import LogWriter, DEBUG, INFO, ERROR
 
 
 class IRCError(Exception):
@@ -13,25 +20,53 @@ class IRCError(Exception):
 
 
 class IRC:
-    buffer_size = 4096     # buffer size for each socket read
-    receive_timeout = 0.5  # how long to wait for socket data in each main loop iteration
+    receive_timeout = 0.5  # how long the asyncio engine waits before retrying lines held back by flood control
+    ping_check_interval = 1  # how often to check if the server needs pinging
     ping_wait = 200        # how long to wait before pinging the server
     ping_timeout = 10      # and how long to wait for a pong when pinging
     ping_text = 'nda'      # text to send with pings
     crlf = '\r\n'          # irc message delimiter
+    send_rate = 1          # lines per second we can send without getting kicked for flooding
+    send_burst = 5         # and how many lines we can send in one go after being quiet
+    rejoin_delay = 2       # how long to wait before rejoining after a kick
 
-    def __init__(self, address, port, user, real_name, nicks, nickserv_password, logging):
+    def __init__(self, address, port, user, real_name, nicks, nickserv_password, logging, engine='select'):
         self.address = address
         self.port = port
         self.user = user
         self.real_name = real_name
         self.nicks = nicks
         self.nickserv_password = nickserv_password
-        self.logging = logging
-
+        self.logging = logging  # true/false, or a dict of LogWriter options plus "file" and "level"
+        self.engine = engine  # 'select' for the classic polling loop, 'asyncio' for irc_async.AsyncEngine
+
+        log_conf = dict(logging) if isinstance(logging, dict) else {}
+        self.logger = LogWriter(
+            log_conf.pop('file', 'nda.log') if logging else None,
+            sys.stdout,
+            **log_conf
+        )
+        self.transport = None  # set by the asyncio engine while it runs the connection
+        self.send_queue = SendQueue(self.send_rate, self.send_burst)
+        self.flush_lock = threading.Lock()  # the asyncio engine flushes from both the loop and the handler thread
+        self.command_handlers = {
+            'PING': self._on_ping,
+            'PONG': self._on_pong,
+            'ERROR': self._on_error,
+            '001': self._on_welcome,
+            '303': self._on_ison,
+            '433': self._on_nick_in_use,
+            'KICK': self._on_kick,
+            'JOIN': self._on_join,
+            'PRIVMSG': self._on_privmsg
+        }
+        self.scheduler = Scheduler(self._wake, self.log)  # timed jobs, the main loop sleeps until the next one is due
+        self.wake_reader, self.wake_writer = socket.socketpair()  # lets other threads interrupt select()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.ping_job = None
         self.socket = None
-        self.lines = []
-        self.unfinished_line = ''
+        self.line_buffer = LineBuffer()
         self.nick_index = 0
         self.connect_time = datetime.min
         self.last_ping = datetime.min
@@ -40,15 +75,11 @@ class IRC:
     def current_nick(self):
         return self.nicks[self.nick_index]
 
-    def log(self, msg):
-        msg = '%s %s' % (datetime.utcnow(), msg)
-        print(msg)
-
-        if self.logging:
-            with open('nda.log', 'a', encoding='utf-8') as f:
-                f.write('%s%s' % (msg, self.crlf))
+    def log(self, msg, level=INFO):
+        # written to stdout and nda.log by the logger's thread, the timestamp is taken here
+        self.logger.write('%s %s' % (datetime.utcnow(), msg), level)
 
-    def send_message(self, to, msg):
+    def send_message(self, to, msg, flush=True):
         if msg is None or len(msg) == 0:
             return
 
@@ -61,18 +92,51 @@ class IRC:
         chunks = [msg[i:i + chunk_size] for i in range(0, len(msg), chunk_size)]
 
         for chunk in chunks:
-            self._send(command + chunk + self.crlf)
+            self.send_queue.put(to, command + chunk + self.crlf)
 
         self.message_sent(to, msg)
 
+        if flush:
+            self._flush_send_queue()
+
     def send_messages(self, to, msgs):
         for msg in msgs:
-            self.send_message(to, msg)
+            self.send_message(to, msg, False)
+        self._flush_send_queue()  # queue everything first so a burst can go out in a single write
+
+    def _flush_send_queue(self):
+        # popping and writing under one lock, otherwise two flushes can write their batches in the opposite order
+        with self.flush_lock:
+            lines = self.send_queue.pop_ready()
+
+            if len(lines) > 0:
+                self._send(''.join(lines))
 
     def _send(self, msg):
         if not msg.endswith(self.crlf):
             msg += self.crlf
-        self.socket.send(msg.encode('utf-8'))
+
+        if self.transport is not None:
+            self.transport.write(msg.encode('utf-8'))
+        else:
+            self.socket.sendall(msg.encode('utf-8'))  # a batch of lines can be more than one send() takes
+
+    def _wake(self):
+        # called by the scheduler, possibly from another thread, when a job is due earlier than the loop expected
+        if self.transport is not None:
+            self.transport.wake()
+        else:
+            try:
+                self.wake_writer.send(b'\0')
+            except OSError:
+                pass  # the buffer is full, so the loop is getting woken anyway
+
+    def _dispatch(self, hook, *args):
+        # subclass hooks run inline in the select loop, the asyncio engine runs them off the event loop instead
+        if self.transport is not None:
+            self.transport.dispatch(hook, *args)
+        else:
+            hook(*args)
 
     def _ping(self, msg):
         self.log('Sending PING :%s' % msg)
@@ -102,55 +166,81 @@ class IRC:
         self._send('QUIT :%s' % quit_message)
 
     def _readline(self):
-        if len(self.lines) > 0:
-            return self.lines.pop(0)  # if any lines are already read, return them in sequence
+        while True:
+            line = self.line_buffer.pop()
 
-        ready, _, _ = select.select([self.socket], [], [], self.receive_timeout)
+            if line is not None:
+                return line  # if any lines are already read, return them in sequence
 
-        if len(ready) == 0:  # if no lines and nothing received, return None
-            return None
+            # sleep until the next scheduled job or until lines held back by flood control can go out
+            delays = [delay for delay in [self.scheduler.next_delay(), self.send_queue.next_send_delay()] if delay is not None]
+            timeout = min(delays) if len(delays) > 0 else None
 
-        buffer = self.socket.recv(self.buffer_size)
-        data = self.unfinished_line + buffer.decode('utf-8', errors='ignore')  # prepend unfinished line to its continuation
-        lines = data.split(self.crlf)
+            ready, _, _ = select.select([self.socket, self.wake_reader], [], [], timeout)
 
-        # if buffer ended on newline, the last element will be empty string
-        # otherwise, the last element will be an unfinished line
-        # if no newlines found in buffer, the entire buffer is an unfinished line (line longer than what recv returned)
-        self.unfinished_line = lines.pop(-1)
-        self.lines = lines
+            if self.wake_reader in ready:
+                self._drain_wakeups()
 
-        return self._readline()  # recurse until a finished line is found or nothing is received within timeout
+            if self.socket not in ready:  # if no lines and nothing received, return None
+                return None
 
-    def _connect(self):
+            if self.line_buffer.recv_from(self.socket) == 0:
+                raise IRCError('Connection closed by the server')
+
+    def _drain_wakeups(self):
+        try:
+            while len(self.wake_reader.recv(4096)) > 0:
+                pass
+        except OSError:
+            pass  # nothing left to read
+
+    def _reset_connection(self):
         now = datetime.utcnow()
-        self.lines = []
-        self.unfinished_line = ''
+        self.line_buffer.clear()
         self.nick_index = 0
         self.connect_time = now
         self.waiting_for_pong = False
         self.last_ping = now
+        self.send_queue.clear()  # whatever was queued for the old connection is stale now
+
+    def _register(self):
+        self._send('USER %s 8 * :%s' % (self.user, self.real_name))
+        self._change_nick(self.current_nick())
+        self.ping_job = self.scheduler.call_every(self.ping_check_interval, self._keepalive, inline=True)
+
+    def _connect(self):
+        self._reset_connection()
 
         self.log('Connecting to %s:%s' % (self.address, self.port))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.address, self.port))
 
-        self._send('USER %s 8 * :%s' % (self.user, self.real_name))
-        self._change_nick(self.current_nick())
+        self._register()
 
     def _disconnect(self, quit_message='quit'):
         self.log('Disconnecting from %s:%s' % (self.address, self.port))
+        self.scheduler.cancel(self.ping_job)
+        self.ping_job = None
 
         try:
             self._quit(quit_message)
-            self.socket.close()
+            if self.transport is not None:
+                self.transport.close()
+            else:
+                self.socket.close()
         except OSError as os_error:
             self.log('An error occurred while disconnecting (%i): %s' % (os_error.errno, os_error.strerror))
 
     def _receive(self):
-        now = datetime.utcnow()
         line = self._readline()  # a line or None if nothing received
 
+        if line is not None:
+            self._handle_line(line)
+
+    def _keepalive(self):
+        self._check_ping(datetime.utcnow())
+
+    def _check_ping(self, now):
         # if the last ping (server or client) happened over ping_wait seconds ago, let's follow up on that
         # if we did not already send a ping, the server hasn't pinged us in a while, so ping it once
         # if that ping doesn't trigger a pong within ping_timeout, the server is in limbo and we want to reconnect
@@ -160,57 +250,63 @@ class IRC:
         elif self.waiting_for_pong and (now - self.last_ping).total_seconds() > self.ping_timeout:
             raise IRCError('No PONG received from the server in %i seconds' % self.ping_timeout)
 
-        if line is None:
-            return
+    def _handle_line(self, line):
+        self.log(line, DEBUG)
+        message = Message.parse(line)
+
+        if message.from_user and message.nick not in self.nicks:  # update last seen whenever anything happens from some nick
+            self._dispatch(self.nick_seen, message.nick)
+
+        handler = self.command_handlers.get(message.command, None)
+
+        if handler is not None:
+            handler(message)
+
+    def _on_ping(self, message):
+        self._pong(' '.join(message.params))
+        self.last_ping = datetime.utcnow()
+
+    def _on_pong(self, message):
+        self.waiting_for_pong = False
+
+    def _on_error(self, message):
+        raise IRCError(' '.join(message.params))
+
+    def _on_welcome(self, message):  # RPL_WELCOME: successful client registration
+        self._dispatch(self._welcome)
+
+    def _on_ison(self, message):  # RPL_ISON: list of online nicks, process mail here
+        self._dispatch(self.ison_result, ' '.join(message.params[1:]).split())
+
+    def _on_nick_in_use(self, message):  # ERR_NICKNAMEINUSE: nick already taken
+        self.nick_index += 1
+        if self.nick_index >= len(self.nicks):
+            self.log('Error: all nicks already in use')
+            raise KeyboardInterrupt
+        self._change_nick(self.current_nick())
 
-        data = line.split()
-        self.log(line)
+    def _on_kick(self, message):
+        channel = message.param(0)
+        if channel is not None and message.param(1) == self.current_nick():
+            self.log('Rejoining %s in %i seconds' % (channel, self.rejoin_delay))
+            self.scheduler.call_later(self.rejoin_delay, lambda: self._join(channel), 'rejoin %s' % channel, inline=True)
 
-        if len(data) < 2:  # smallest message we want is PING :msg
+    def _on_join(self, message):  # process mail as soon as the user joins instead of after passive_interval seconds
+        if message.from_user and message.nick != self.current_nick():  # disregard own joins
+            self._dispatch(self.nick_joined, message.nick)
+
+    def _on_privmsg(self, message):
+        if not message.from_user or len(message.params) < 2:
             return
+        target = message.params[0]
+        reply_target = target if is_channel(target) else message.nick  # channel or direct message
+        self._dispatch(self.message_received, message.trailing, reply_target, message.nick)
 
-        if not data[0].startswith(':'):  # distinguish between message formats
-            command = data[0]
+    def _welcome(self):
+        if self.nickserv_password is not None and len(self.nickserv_password) > 0:
+            self.send_message('NickServ', 'IDENTIFY %s' % self.nickserv_password)
 
-            if command == 'PING':
-                self._pong(' '.join(data[1:]).lstrip(':'))
-                self.last_ping = datetime.utcnow()
-            elif command == 'ERROR':
-                raise IRCError(line)
-        else:
-            source = data[0].lstrip(':')
-            source_nick = source.split('!')[0]
-            command = data[1]
-
-            if '!' in source and source_nick not in self.nicks:  # update last seen whenever anything happens from some nick
-                self.nick_seen(source_nick)
-
-            if command == '001':  # RPL_WELCOME: successful client registration
-                if self.nickserv_password is not None and len(self.nickserv_password) > 0:
-                    self.send_message('NickServ', 'IDENTIFY %s' % self.nickserv_password)
-
-                self.connected()
-            elif command == '303':  # RPL_ISON: list of online nicks, process mail here
-                self.ison_result(' '.join(data[3:]).lstrip(':').split())
-            elif command == '433':  # ERR_NICKNAMEINUSE: nick already taken
-                self.nick_index += 1
-                if self.nick_index >= len(self.nicks):
-                    self.log('Error: all nicks already in use')
-                    raise KeyboardInterrupt
-                self._change_nick(self.current_nick())
-            elif command == 'PONG':
-                self.waiting_for_pong = False
-            elif command == 'KICK':
-                time.sleep(2)
-                self._join(data[2])
-            elif command == 'JOIN':  # process mail as soon as the user joins instead of after passive_interval seconds
-                if source_nick != self.current_nick():  # disregard own joins
-                    self.nick_joined(source_nick)
-            elif command == 'PRIVMSG':
-                target = data[2]
-                reply_target = target if is_channel(target) else source_nick  # channel or direct message
-                message = ' '.join(data[3:]).lstrip(':')
-                self.message_received(message, reply_target, source_nick)
+        self.connected()
 
     def _main_loop(self):
         disconnect = False
@@ -228,28 +324,37 @@ class IRC:
                     connect = False
 
                 self._receive()
+                self.scheduler.run_due()
                 self.main_loop_iteration()
+                self._flush_send_queue()
             except IRCError as irc_error:
-                self.log('IRC error: %s' % irc_error.args)
+                self.log('IRC error: %s' % irc_error.args, ERROR)
                 disconnect = True
                 connect = True
             except OSError as os_error:
-                self.log('OS error (errno %s): %s' % (str(os_error.errno), os_error.strerror))
+                self.log('OS error (errno %s): %s' % (str(os_error.errno), os_error.strerror), ERROR)
                 disconnect = True
                 connect = True
             except KeyboardInterrupt:
                 self._disconnect('nda loves you :)')
                 break
             except Exception as error:
-                self.log('Unknown error (%s): %s' % (str(type(error)), error.args))
-                self.log(traceback.format_exc())
+                self.log('Unknown error (%s): %s' % (str(type(error)), error.args), ERROR)
+                self.log(traceback.format_exc(), ERROR)
                 self.unknown_error_occurred(error)
                 time.sleep(10)
 
     def start(self):
         self.started()
-        self._main_loop()
+
+        if self.engine == 'asyncio':
+            from irc_async import AsyncEngine  # only needed when asked for
+            AsyncEngine(self).run()
+        else:
+            self._main_loop()
+
         self.stopped()
+        self.logger.close()
 
     # abstract methods for subclasses:
 
@@ -257,7 +362,7 @@ class IRC:
 
     def ison_result(self, nicks): pass
 
-    def main_loop_iteration(self): pass
+    def main_loop_iteration(self): pass  # after every received line and every wakeup, timed work belongs in self.scheduler
 
     def message_received(self, message, reply_target, source_nick): pass
 
@@ -0,0 +1,208 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from irc import IRCError
+from log_writer import ERROR
+
+
+class AsyncEngine:
+    """
+    Runs an IRC connection on asyncio instead of the select() polling in IRC._main_loop.
+    The socket is read through a StreamReader and scheduled jobs run from their own task, while the subclass hooks
+    (connected, message_received, nick_seen, main_loop_iteration, ...) and jobs run one at a time on a single handler
+    thread. Inline jobs like the ping check run on the event loop, so a slow handler only holds up the handlers queued
+    behind it, never reading from the server or answering pings.
+    """
+    reconnect_delay = 5     # how long to wait before reconnecting after an error
+
+    def __init__(self, irc):
+        self.irc = irc
+        self.handlers = ThreadPoolExecutor(max_workers=1, thread_name_prefix='irc-handler')
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.stopping = None   # resolved when something asks the bot to quit
+        self.wakeup = None     # set when the scheduler has a new earliest job
+        self.iteration = None  # the pending main_loop_iteration, so they don't pile up behind a slow handler
+        self.running_jobs = set()  # jobs waiting for or running on the handler thread, so a periodic job doesn't pile up
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.handlers.shutdown(wait=True)
+
+    # transport interface used by IRC
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self._write, data)  # may be called from the handler thread
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def dispatch(self, hook, *args):
+        future = self.loop.run_in_executor(self.handlers, hook, *args)
+        future.add_done_callback(self._handler_done)
+        return future
+
+    def _write(self, data):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def _stop(self):
+        if not self.stopping.done():
+            self.stopping.set_result(None)
+
+    def _handler_done(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+
+        error = future.exception()
+
+        if isinstance(error, KeyboardInterrupt):  # e.g. !die
+            self._stop()
+            return
+
+        self.irc.log('Unknown error (%s): %s' % (str(type(error)), error.args))
+        self.irc.log(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        self.dispatch(self.irc.unknown_error_occurred, error)
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = self.loop.create_future()
+        self.wakeup = asyncio.Event()
+        self.irc.transport = self
+
+        try:
+            while True:
+                try:
+                    await self._session()
+                except IRCError as irc_error:
+                    self.irc.log('IRC error: %s' % irc_error.args, ERROR)
+                except OSError as os_error:
+                    self.irc.log('OS error (errno %s): %s' % (str(os_error.errno), os_error.strerror), ERROR)
+                except Exception as error:  # e.g. a line the parser chokes on, reconnect rather than die
+                    self.irc.log('Unknown error (%s): %s' % (str(type(error)), error.args), ERROR)
+                    self.irc.log(traceback.format_exc(), ERROR)
+                    self.dispatch(self.irc.unknown_error_occurred, error)
+
+                if self.stopping.done():
+                    self.irc._disconnect('nda loves you :)')
+                    await self._closed()
+                    break
+
+                self.irc._disconnect('an error occurred, reconnecting')
+                await self._closed()
+                await asyncio.sleep(self.reconnect_delay)
+        except asyncio.CancelledError:  # ctrl+c
+            self.irc._disconnect('nda loves you :)')
+            await self._closed()
+            raise
+        finally:
+            self.irc.transport = None
+
+    async def _session(self):
+        self.irc._reset_connection()
+        self.irc.log('Connecting to %s:%s' % (self.irc.address, self.irc.port))
+        self.reader, self.writer = await asyncio.open_connection(self.irc.address, self.irc.port)
+        self.irc._register()
+
+        coroutines = [self._read_lines(), self._run_jobs(), self._send_queued()]
+        tasks = [self.loop.create_task(coroutine) for coroutine in coroutines]
+
+        try:
+            done, _ = await asyncio.wait(tasks + [self.stopping], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        for task in done:
+            if task is not self.stopping:
+                task.result()  # re-raise whatever ended the session
+
+    async def _closed(self):
+        if self.writer is None:
+            return
+
+        await asyncio.sleep(0)  # let the writes and the close queued by IRC._disconnect run first
+
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+        self.writer = None
+
+    async def _read_lines(self):
+        while True:
+            line_buffer = self.irc.line_buffer
+            buffer = await self.reader.read(line_buffer.recv_size)
+
+            if len(buffer) == 0:
+                raise IRCError('Connection closed by the server')
+
+            line_buffer.feed(buffer)
+
+            try:
+                line = line_buffer.pop()
+                while line is not None:
+                    self.irc._handle_line(line)
+                    line = line_buffer.pop()
+            except KeyboardInterrupt:  # e.g. all nicks in use
+                self._stop()
+                return
+
+    async def _run_jobs(self):
+        scheduler = self.irc.scheduler
+
+        while True:
+            self.wakeup.clear()  # before asking for the delay, so a job added in between still wakes us
+            delay = scheduler.next_delay()
+
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+            inline_error = None
+            for job in scheduler.pop_due():
+                if job.cancelled:  # an earlier inline job in the same batch may have cancelled it
+                    continue
+                elif job.inline:
+                    try:
+                        job.func()
+                    except Exception as error:  # e.g. the ping check, an IRCError from it ends the session
+                        inline_error = inline_error if inline_error is not None else error
+                elif job not in self.running_jobs:
+                    self.running_jobs.add(job)
+                    self.dispatch(self._run_job, job)
+
+            if inline_error is not None:
+                raise inline_error  # only once the rest of the batch has been handed out
+
+            if self.iteration is None or self.iteration.done():
+                self.iteration = self.dispatch(self.irc.main_loop_iteration)
+
+    def _run_job(self, job):
+        try:
+            if not job.cancelled:
+                job.func()
+        finally:
+            self.loop.call_soon_threadsafe(self.running_jobs.discard, job)
+
+    async def _send_queued(self):
+        # lines that flood control held back when they were queued go out from here
+        while True:
+            delay = self.irc.send_queue.next_send_delay()
+            await asyncio.sleep(min(delay, self.irc.receive_timeout) if delay is not None else self.irc.receive_timeout)
+            self.irc._flush_send_queue()
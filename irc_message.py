@@ -0,0 +1,169 @@
+import re
+import sys
+import timeit
+from types import MappingProxyType
+
+tag_escape = re.compile(r'\\(.?)', re.DOTALL)
+tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+no_tags = MappingProxyType({})  # shared by every message without tags, read only so nobody fills it by accident
+
+
+def _unescape_tag(match):
+    char = match.group(1)
+    return tag_escapes.get(char, char)  # unknown escapes drop the backslash, a trailing backslash is dropped entirely
+
+
+def parse_tags(raw_tags):
+    tags = {}
+    for tag in raw_tags.split(';'):
+        if len(tag) == 0:
+            continue
+        key, _, value = tag.partition('=')
+        tags[key] = tag_escape.sub(_unescape_tag, value) if '\\' in value else value
+    return tags
+
+
+class Message:
+    """a single parsed irc line: [@tags] [:source] command [params...] [:trailing]"""
+    __slots__ = ('tags', 'source', 'nick', 'from_user', 'command', 'params', 'trailing')
+
+    def __init__(self, tags, source, command, params):
+        self.tags = tags        # IRCv3 message tags, an empty read only mapping if there were none
+        self.source = source    # nick!user@host or server name, None if the line had no prefix
+        self.nick = source.partition('!')[0] if source is not None else None
+        self.from_user = source is not None and '!' in source
+        self.command = command  # upper case command or numeric
+        self.params = params    # middle params with the trailing param (if any) last
+        self.trailing = params[-1] if len(params) > 0 else ''
+
+    @classmethod
+    def parse(cls, line, new=object.__new__):
+        # this runs for every received line, so it fills the slots directly instead of going through __init__ and
+        # works out nick/from_user/trailing once here instead of in properties the handlers call again and again
+        message = new(cls)
+
+        if line[:1] == '@':
+            raw_tags, _, line = line[1:].partition(' ')
+            message.tags = parse_tags(raw_tags)
+            line = line.lstrip(' ')
+        else:
+            message.tags = no_tags
+
+        middle, separator, trailing = line.partition(' :')
+        params = middle.split()
+
+        if line[:1] == ':':
+            source = message.source = params.pop(0)[1:]
+            message.nick, bang, _ = source.partition('!')
+            message.from_user = bang == '!'
+        else:
+            message.source = message.nick = None
+            message.from_user = False
+
+        message.command = params.pop(0).upper() if params else ''
+
+        if separator:
+            params.append(trailing)
+        message.params = params
+        message.trailing = params[-1] if params else ''
+        return message
+
+    def param(self, i, default=None):
+        return self.params[i] if i < len(self.params) else default
+
+    def __repr__(self):
+        return 'Message(%r, %r, %r, %r)' % (self.tags, self.source, self.command, self.params)
+
+
+sample_corpus = [
+    ':nick!user@host.example.com PRIVMSG #channel :hello there, how is everyone doing today?',
+    ':nick!user@host.example.com PRIVMSG #channel :https://www.youtube.com/watch?v=dQw4w9WgXcQ check this out',
+    '@time=2016-01-01T12:00:00.000Z;account=nick :nick!user@host.example.com PRIVMSG #channel :tagged message',
+    '@+draft/reply=abc\\sdef;msgid=123 :other!user@host PRIVMSG #channel :a reply',
+    ':other!~user@1.2.3.4 JOIN #channel',
+    ':other!~user@1.2.3.4 QUIT :Quit: leaving',
+    ':irc.example.com 353 nda = #channel :nda @op +voice a b c d e f g h i j k l m n o p',
+    ':irc.example.com 303 nda :alias1 master2',
+    'PING :irc.example.com',
+    ':op!user@host KICK #channel nda :bye',
+]
+
+
+def _legacy_handle(line):
+    # what the old IRC._handle_line did for every line: split it, then re-split and re-join parts in the handlers
+    data = line.split()
+    if len(data) < 2:
+        return None
+
+    if not data[0].startswith(':'):
+        command = data[0]
+        if command == 'PING':
+            return ' '.join(data[1:]).lstrip(':')
+        return command
+
+    source = data[0].lstrip(':')
+    source_nick = source.split('!')[0]
+    command = data[1]
+    seen = source_nick if '!' in source else None
+
+    if command == '303':
+        return ' '.join(data[3:]).lstrip(':').split()
+    elif command == 'KICK':
+        return data[2]
+    elif command == 'JOIN':
+        return source_nick
+    elif command == 'PRIVMSG':
+        return data[2], ' '.join(data[3:]).lstrip(':'), source_nick
+    return seen
+
+
+def _handle(line):
+    # the same work done by Message.parse and what the IRC._on_* handlers take from the message
+    message = Message.parse(line)
+    command = message.command
+
+    if command == 'PING':
+        return ' '.join(message.params)
+
+    seen = message.nick if message.from_user else None
+
+    if command == '303':
+        return ' '.join(message.params[1:]).split()
+    elif command == 'KICK':
+        return message.param(0), message.param(1)
+    elif command == 'JOIN':
+        return message.nick
+    elif command == 'PRIVMSG':
+        return message.params[0], message.trailing, message.nick
+    return seen
+
+
+def load_corpus(filename):
+    """raw lines from a file of recorded traffic, e.g. an nda.log, where received lines follow the log timestamp"""
+    lines = []
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            parts = line.split(' ', 2)
+            if len(parts) == 3 and parts[2][:1] in ':@':
+                line = parts[2]  # strip the "date time" prefix from log lines
+            if line[:1] in ':@' or line.startswith('PING'):
+                lines.append(line)
+    return lines
+
+
+if __name__ == '__main__':
+    # e.g. python3 irc_message.py nda.log
+    # the bot doesn't request the message-tags capability, so the default corpus leaves the tagged samples out
+    corpus = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else [line for line in sample_corpus if line[:1] != '@'] * 100
+    runs = 50
+    print('%i lines' % len(corpus))
+    results = {}
+
+    for name, handle in [('old split + handlers', _legacy_handle), ('Message + handlers', _handle),
+                         ('Message.parse only', Message.parse)]:
+        seconds = min(timeit.repeat(lambda: [handle(line) for line in corpus], number=1, repeat=runs))
+        results[name] = seconds / len(corpus) * 1e6
+        print('%-22s %.2f us/line' % (name, results[name]))
+
+    print('full path: %.2fx the old cost' % (results['Message + handlers'] / results['old split + handlers']))
@@ -0,0 +1,82 @@
+from collections import deque
+
+
+class LineBuffer:
+    """
+    Frames a byte stream into CRLF terminated lines. Bytes are received straight into a reusable buffer and
+    complete lines wait in a deque as raw bytes until someone pops them, so only the lines that are actually
+    read get decoded. The receive size grows while reads keep filling it (bursts) and shrinks again when idle.
+    """
+    min_recv_size = 4096
+    max_recv_size = 65536
+    max_line_length = 65536  # drop unterminated garbage beyond this instead of buffering it forever
+    crlf = b'\r\n'
+
+    def __init__(self):
+        self.recv_size = self.min_recv_size
+        self.recv_buffer = bytearray(self.max_recv_size)
+        self.pending = bytearray()  # the unfinished line
+        self.scanned = 0            # how much of pending is known not to contain a line ending
+        self.discarding = False     # pending is the tail of a line that was too long, drop it up to its CRLF
+        self.lines = deque()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def clear(self):
+        self.recv_size = self.min_recv_size
+        self.pending.clear()
+        self.scanned = 0
+        self.discarding = False
+        self.lines.clear()
+
+    def recv_from(self, sock):
+        """reads once from a socket, returns the number of bytes received (0 when the connection is closed)"""
+        view = memoryview(self.recv_buffer)
+        try:
+            received = sock.recv_into(view[:self.recv_size])
+            self.feed(view[:received])
+        finally:
+            view.release()
+        return received
+
+    def feed(self, data):
+        self._adapt(len(data))
+        self.pending += data
+        start = 0
+        end = self.pending.find(self.crlf, max(self.scanned - 1, 0))  # step back one, the \r may have been the last byte
+
+        while end != -1:
+            if self.discarding:
+                self.discarding = False  # the end of a line that was too long, passing it on would be a bogus message
+            else:
+                self.lines.append(bytes(self.pending[start:end]))
+            start = end + len(self.crlf)
+            end = self.pending.find(self.crlf, start)
+
+        del self.pending[:start]
+        self.scanned = len(self.pending)
+
+        if self.scanned > self.max_line_length:
+            # keep a trailing \r in case the \n that ends the line is the first byte of the next read
+            tail = self.pending[-1:] if self.pending.endswith(b'\r') else b''
+            self.pending[:] = tail
+            self.scanned = len(self.pending)
+            self.discarding = True
+
+    def pop(self):
+        """returns the next complete line as a str, or None if there is none yet"""
+        if len(self.lines) == 0:
+            return None
+
+        line = self.lines.popleft()
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            return line.decode('latin-1')  # older clients still send latin-1, and every byte sequence is valid latin-1
+
+    def _adapt(self, received):
+        if received >= self.recv_size and self.recv_size < self.max_recv_size:
+            self.recv_size *= 2
+        elif received < self.recv_size // 4 and self.recv_size > self.min_recv_size:
+            self.recv_size //= 2
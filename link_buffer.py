@@ -0,0 +1,107 @@
+import time
+import threading
+import traceback
+from collections import deque
+from metrics import Histogram
+
+
+class LinkBuffer:
+    """
+    Keeps a few ready-made links per generator (imgur, reddit, ...) so commands can answer right away instead of
+    searching while the user waits. A background thread tops the buffers up again after links are taken, and links
+    older than max_age are thrown away since random links tend to die.
+    """
+    size = 3              # links kept ready per generator
+    max_age = 30 * 60     # seconds before a buffered link is considered stale
+    retry_delay = 60      # seconds to leave a generator alone after it failed to produce a link
+    check_interval = 30   # how often the refill thread wakes up on its own to replace expired links
+
+    def __init__(self, generators, size=None, max_age=None, log=None):
+        self.generators = generators  # name => function returning a link, or an error message/None on failure
+        self.size = size if size is not None else self.size
+        self.max_age = max_age if max_age is not None else self.max_age
+        self.log = log if log is not None else print
+        self.links = {name: deque() for name in generators}  # name => deque of (created, link), oldest first
+        self.retry_at = {name: 0 for name in generators}
+        self.refill_latency = {name: Histogram() for name in generators}
+        self.hits = 0
+        self.misses = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name='link-buffer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def pop(self, name):
+        """returns a buffered link, or None if there is no fresh one and the caller has to generate one itself"""
+        with self.condition:
+            links = self.links[name]
+            self._expire(links, time.monotonic())
+
+            if len(links) == 0:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.condition.notify()  # wake the refill thread
+            return links.popleft()[1]
+
+    def generate(self, name):
+        return self.generators[name]()
+
+    def stats(self):
+        with self.condition:
+            occupancy = ' '.join('%s=%i/%i' % (name, len(links), self.size) for name, links in self.links.items())
+            return 'hits=%i misses=%i %s' % (self.hits, self.misses, occupancy)
+
+    def latency_stats(self):
+        return ['refill %s: %s' % (name, histogram.summary()) for name, histogram in self.refill_latency.items()
+                if histogram.count > 0]
+
+    def _expire(self, links, now):
+        while len(links) > 0 and now - links[0][0] > self.max_age:
+            links.popleft()
+
+    def _next_to_refill(self, now):
+        for name, links in self.links.items():
+            self._expire(links, now)
+            if len(links) < self.size and now >= self.retry_at[name]:
+                return name
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                name = None
+                while not self.stopping:
+                    name = self._next_to_refill(time.monotonic())
+                    if name is not None:
+                        break
+                    self.condition.wait(self.check_interval)
+
+                if self.stopping:
+                    return
+
+            start = time.monotonic()
+            try:
+                link = self.generators[name]()
+            except Exception as error:
+                self.log('Link buffer refill for %s failed (%s): %s' % (name, str(type(error)), error.args))
+                self.log(traceback.format_exc())
+                link = None
+            now = time.monotonic()
+            self.refill_latency[name].observe(now - start)
+
+            with self.condition:
+                if link is not None and (link.startswith('http://') or link.startswith('https://')):
+                    self.links[name].append((now, link))
+                else:
+                    self.retry_at[name] = now + self.retry_delay  # don't hammer a generator that isn't working
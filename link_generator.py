@@ -2,9 +2,10 @@ import random
 import json
 import re
 from datetime import datetime, timedelta
-import requests
 import requests.auth
 from requests.exceptions import RequestException
+from http_client import HttpClient
+from prober import Prober
 
 
 class LinkGenerator:
@@ -20,7 +21,9 @@ class LinkGenerator:
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36'
     ]
 
-    def __init__(self, reddit_key=None, reddit_secret=None, pastebin_api_key=None):
+    def __init__(self, reddit_key=None, reddit_secret=None, pastebin_api_key=None, http=None):
+        self.http = http if http is not None else HttpClient()
+        self.prober = Prober()  # checks imgur and reddit candidates in parallel
         self.reddit_key = reddit_key
         self.reddit_secret = reddit_secret
         self.pastebin_api_key = pastebin_api_key
@@ -29,41 +32,11 @@ class LinkGenerator:
 
     def imgur(self):
         chars = self.lowercase_chars + self.uppercase_chars + self.numbers
-
-        for _ in range(0, self.max_tries):
-            combination = self._generate_combination(chars, 5)
-            url = 'http://i.imgur.com/%s.jpg' % combination
-
-            try:
-                response = requests.head(url, timeout=self.timeout, headers={
-                    'User-Agent': random.choice(self.user_agents)
-                })
-
-                if response.status_code == 200:
-                    return url
-            except RequestException:
-                return 'connection failed, please try again later :('
-
-        return 'couldn\'t find a valid link in %i tries :(' % self.max_tries
+        return self._probe('imgur', lambda: 'http://i.imgur.com/%s.jpg' % self._generate_combination(chars, 5))
 
     def reddit(self):
         chars = self.lowercase_chars + self.numbers
-
-        for _ in range(0, self.max_tries):
-            combination = self._generate_combination(chars, 4)
-            url = 'https://www.reddit.com/r/all/comments/3t%s' % combination
-
-            try:
-                response = requests.head(url, timeout=self.timeout, headers={
-                    'User-Agent': random.choice(self.user_agents)
-                })
-
-                if response.status_code == 200:
-                    return url
-            except RequestException:
-                return 'connection failed, please try again later :('
-
-        return 'couldn\'t find a valid link in %i tries :(' % self.max_tries
+        return self._probe('reddit', lambda: 'https://www.reddit.com/r/all/comments/3t%s' % self._generate_combination(chars, 4))
 
     def xhamster(self):
         gay = random.randint(0, 1) == 1
@@ -74,7 +47,7 @@ class LinkGenerator:
 
         def request(https=False):
             protocol = 'https' if https else 'http'
-            response = requests.head(
+            response = self.http.head(
                 protocol + '://xhamster.com/random.php',
                 timeout=self.timeout,
                 headers={
@@ -104,7 +77,7 @@ class LinkGenerator:
     def wikihow(self):
         for _ in range(0, self.max_tries):
             try:
-                response = requests.head(
+                response = self.http.head(
                     'http://www.wikihow.com/Special:Randomizer',
                     timeout=self.timeout,
                     headers={
@@ -131,7 +104,7 @@ class LinkGenerator:
             return None
 
         try:
-            response = requests.get(api_url, headers={
+            response = self.http.get(api_url, headers={
                 'Authorization': 'bearer %s' % access_token,
                 'User-Agent': user_agent
             })
@@ -160,11 +133,25 @@ class LinkGenerator:
         }
 
         try:
-            response = requests.post(url, data)
+            response = self.http.post(url, data)
             return response.text if response.text.startswith('http://') else None
         except:
             return None
 
+    def _probe(self, name, candidate):
+        try:
+            url = self.prober.probe(name, candidate, self._exists, self.max_tries)
+        except RequestException:
+            return 'connection failed, please try again later :('
+
+        return url if url is not None else 'couldn\'t find a valid link in %i tries :(' % self.max_tries
+
+    def _exists(self, url):
+        response = self.http.head(url, timeout=self.timeout, headers={
+            'User-Agent': random.choice(self.user_agents)
+        })
+        return response.status_code == 200
+
     def _generate_combination(self, chars, length):
         return ''.join([chars[random.randint(0, len(chars) - 1)] for i in range(length)])
 
@@ -179,7 +166,7 @@ class LinkGenerator:
             auth = requests.auth.HTTPBasicAuth(self.reddit_key, self.reddit_secret)
 
             try:
-                response = requests.post(
+                response = self.http.post(
                     'https://www.reddit.com/api/v1/access_token',
                     auth=auth,
                     data={
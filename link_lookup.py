@@ -2,14 +2,24 @@ import re
 import json
 import html
 import html.parser
+import codecs
 import random
-import requests
+from urllib.parse import urlsplit, urlunsplit
 from requests.exceptions import RequestException
 from twitter import Twitter
+from ttl_cache import TTLCache
+from http_client import HttpClient
+from micro_batcher import MicroBatcher
+from trigger_scanner import TriggerScanner
+
+
+title_regex = re.compile(r'<title[^>]*>([^<]*)</title\s*>', re.IGNORECASE)
 
 
 class LinkLookup:
     timeout = 5
+    title_chunk_size = 8192
+    title_max_bytes = 512 * 1024  # give up on pages that haven't closed their title by then
     user_agents = [
         'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36',
         'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36',
@@ -17,71 +27,110 @@ class LinkLookup:
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36'
     ]
 
-    def __init__(self, youtube_api_key=None, twitter=None):
+    def __init__(self, youtube_api_key=None, twitter=None, cache=None, http=None):
+        self.http = http if http is not None else HttpClient()
         self.youtube_api_key = youtube_api_key
         self.twitter_api = twitter
+        self.cache = cache if cache is not None else TTLCache()  # titles by video id, tweet id or normalized url
+        self.youtube_batcher = MicroBatcher(self._fetch_youtube)  # one api request for ids pasted around the same time
 
-    def contains_youtube(self, message):
-        return self._extract_youtube_id(message) is not None
-
-    def youtube(self, message):
+    def youtube_titles(self, youtube_ids):
         if self.youtube_api_key is None or len(self.youtube_api_key) == 0:
-            return None
+            return []
 
-        youtube_id = self._extract_youtube_id(message)
+        titles = {}
+        missing = []
 
-        if youtube_id is None:
-            return None
+        for youtube_id in youtube_ids:
+            found, title = self.cache.get('youtube:' + youtube_id)
+            if found:
+                titles[youtube_id] = title
+            else:
+                missing.append(youtube_id)
+
+        if len(missing) > 0:
+            for youtube_id, title in self.youtube_batcher.get(missing).items():
+                self.cache.put('youtube:' + youtube_id, title)
+                titles[youtube_id] = title
+
+        return [titles[youtube_id] for youtube_id in youtube_ids if titles[youtube_id] is not None]
 
+    def _fetch_youtube(self, youtube_ids):
         try:
-            response = requests.get(
-                'https://www.googleapis.com/youtube/v3/videos?part=snippet,contentDetails&id=%s&key=%s' % (youtube_id, self.youtube_api_key),
+            response = self.http.get(
+                'https://www.googleapis.com/youtube/v3/videos?part=snippet,contentDetails&id=%s&key=%s' % (','.join(youtube_ids), self.youtube_api_key),
                 timeout=self.timeout
             )
             json_data = response.json()
+            titles = {}
 
-            if 'items' in json_data and len(json_data['items']) > 0:
-                title = json_data['items'][0]['snippet']['title']
-                duration = self._youtube_duration(json_data['items'][0]['contentDetails']['duration'])
-                return '%s [%s]' % (title, duration)
-            else:
-                return None
+            for item in json_data.get('items', []):
+                title = item['snippet']['title']
+                duration = self._youtube_duration(item['contentDetails']['duration'])
+                titles[item['id']] = '%s [%s]' % (title, duration)
+
+            return titles
         except RequestException:
-            return None
+            return {}
 
-    def contains_link(self, message):
-        return self._extract_link(message) is not None
+    def link_titles(self, links):
+        titles = []
 
-    def generic(self, message):
-        link = self._extract_link(message)
+        for link in links:
+            title = self.cache.get_or_fetch('url:' + self._normalize_link(link), lambda: self._fetch_title(link))
+            if title is not None:
+                titles.append(title)
 
-        if link is None:
-            return None
+        return titles
 
+    def _fetch_title(self, link):
         try:
-            response = requests.get(link, timeout=self.timeout, headers={
+            response = self.http.get(link, timeout=self.timeout, stream=True, headers={
                 'Accept-Language': 'en-US',  # to avoid geo-specific response language from e.g. twitter
                 'User-Agent': random.choice(self.user_agents)
             })
 
-            if response.status_code != 200 or 'text/html' not in response.headers.get('Content-Type', '').lower():
-                return None
+            # the body is only read if it's html, and only until the title is over
+            with response:
+                if response.status_code != 200 or 'text/html' not in response.headers.get('Content-Type', '').lower():
+                    return None
 
-            parser = PageTitleParser()
-            parser.feed(response.text)
-            title = parser.title
+                title = self._stream_title(response)
 
             if title is not None and len(title.strip()) > 0:
                 return title.strip()
             return None
-        except RequestException:
+        except (RequestException, LookupError):  # LookupError: the server sent an unknown charset
             return None
 
+    def _stream_title(self, response):
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        parser = PageTitleParser()
+        text = ''
+        received = 0
+
+        for chunk in response.iter_content(self.title_chunk_size):
+            received += len(chunk)
+            decoded = decoder.decode(chunk)
+            start = max(len(text) - 1024, 0)  # only look back far enough for a title that started in the last chunk
+            text += decoded
+
+            # most pages have a plain <title>...</title> that a regex finds faster than the parser
+            match = title_regex.search(text, start)
+            if match is not None:
+                return ' '.join(html.unescape(match.group(1)).split())
+
+            parser.feed(decoded)
+            if parser.done or received >= self.title_max_bytes:
+                break
+
+        return parser.title
+
     def xhamster_comment(self, link):
         parser = XhamsterCommentParser()
 
         try:
-            response = requests.get(link, timeout=self.timeout, headers={
+            response = self.http.get(link, timeout=self.timeout, headers={
                 'User-Agent': random.choice(self.user_agents)
             })
             parser.feed(response.text)
@@ -91,15 +140,20 @@ class LinkLookup:
         comments = sorted(parser.comments, key=len, reverse=True)
         return comments[0] if len(comments) > 0 else 'no comments :('
 
-    def contains_twitter(self, message):
-        return self._extract_twitter_id(message) is not None
+    def tweets(self, tweet_ids):
+        if self.twitter_api is None:
+            return []
 
-    def twitter(self, message):
-        tweet_id = self._extract_twitter_id(message)
+        tweets = []
 
-        if tweet_id is None or self.twitter_api is None:
-            return None
+        for tweet_id in tweet_ids:
+            tweet = self.cache.get_or_fetch('twitter:' + tweet_id, lambda: self._fetch_tweet(tweet_id))
+            if tweet is not None:
+                tweets.append(tweet)
+
+        return tweets
 
+    def _fetch_tweet(self, tweet_id):
         tweet = self.twitter_api.fetch(tweet_id)
 
         if tweet is not None:
@@ -109,26 +163,10 @@ class LinkLookup:
             return '%s (@%s): %s' % (author, handle, text)
         return None
 
-    def _extract_link(self, message):
-        match = re.search(r'.*(http(s)?://.+)(\s+|$)', message)
-
-        if match is not None and len(match.groups()) == 3:
-            return match.group(1)
-        return None
-
-    def _extract_youtube_id(self, message):
-        match = re.search(r'(youtube.com/watch\?v=|youtu.be/)([a-zA-Z0-9_\-]{11})', message)
-
-        if match is not None and len(match.groups()) == 2:
-            return match.group(2)
-        return None
-
-    def _extract_twitter_id(self, message):
-        match = re.search(r'twitter.com/.+/status/(\d+)', message)
-
-        if match is not None and len(match.groups()) == 1:
-            return match.group(1)
-        return None
+    def _normalize_link(self, link):
+        # scheme and host are case insensitive and the fragment never reaches the server
+        parts = urlsplit(link)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
 
     def _youtube_duration(self, duration):
         match = re.match(r'^P(\d+W)?(\d+D)?T(\d+H)?(\d+M)?(\d+S)?$', duration)
@@ -162,6 +200,7 @@ class PageTitleParser(html.parser.HTMLParser):
         self.in_head = False
         self.in_title = False
         self.title = None
+        self.done = False  # the title or the head is over, nothing more to find
 
     def handle_starttag(self, tag, attrs):
         if tag == 'head':
@@ -169,6 +208,8 @@ class PageTitleParser(html.parser.HTMLParser):
         self.in_title = self.in_head and tag == 'title'
 
     def handle_endtag(self, tag):
+        if tag == 'head' or (tag == 'title' and self.in_title):
+            self.done = True
         if tag == 'head':
             self.in_head = False
         self.in_title = False
@@ -220,9 +261,9 @@ if __name__ == '__main__':
             conf.get('twitter_access_token_secret', None)
         )
     )
-    print(ll.youtube('https://www.youtube.com/watch?v=g6QW-rFtKfA&feature=youtu.be&t=1529'))
-    print(ll.youtube('https://www.youtube.com/watch?v=TyTdO5RZY3c'))
-    print(ll.generic('hi here is a link for you https://twitter.com/qataraxia/status/672901207845961728'))
+    scanner = TriggerScanner()
+    youtube_ids = scanner.scan('two at once https://youtu.be/g6QW-rFtKfA&feature=youtu.be&t=1529 and https://www.youtube.com/watch?v=TyTdO5RZY3c').youtube_ids
+    print(ll.youtube_titles(youtube_ids))
+    print(ll.link_titles(scanner.scan('hi here is a link for you http://i.imgur.com/wtWCbcf.gifv').links))
     print(ll.xhamster_comment('http://xhamster.com/movies/3949336/merry_christmas_and_happy_new_year.html'))
-    print(ll.generic('http://i.imgur.com/wtWCbcf.gifv'))
-    print(ll.twitter('laugh at the stupid man https://twitter.com/seanspicer/status/427614837749723136'))
+    print(ll.tweets(scanner.scan('laugh at the stupid man https://twitter.com/seanspicer/status/427614837749723136').tweet_ids))
@@ -0,0 +1,190 @@
+import re
+import time
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from multiprocessing import Pool
+
+irssi_day_changed = re.compile(r'^--- Day changed .{3} (\w{3}) (\d{2}) (\d{4})$')
+irssi_log_opened = re.compile(r'^--- Log opened .{3} (\w{3}) (\d{2}) .{8} (\d{4})$')
+irssi_message = re.compile(r'^(\d\d):(\d\d)\s<(.+?)>\s(.+)$')  # 12:34 <&author> message
+hexchat_begin = re.compile(r'^\*\*\*\* BEGIN LOGGING AT .* (\d{4})$')
+hexchat_message = re.compile(r'^(.{15})\s<(.+?)>\s(.+)$')  # jan 01 12:34:56 <author> message
+
+months = {m: i + 1 for i, m in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+
+progress_interval = 20000  # print progress every this many lines
+chunk_lines = 50000        # roughly how many lines each worker process parses at a time
+chunks_in_flight = 2       # chunks per worker process queued or parsed ahead of the insert loop
+
+
+def _utc_offset_padded(utc_offset):
+    return ('+' if utc_offset >= 0 else '') + str(utc_offset).zfill(2 if utc_offset >= 0 else 3) + '00'
+
+
+def _day_timestamp(year, month, day, tz):
+    return int(datetime(year, month, day, tzinfo=tz).timestamp())
+
+
+def parse_irssi(lines, utc_offset=0):
+    """yields (timestamp, author, message) for every message line in an irssi log"""
+    tz = timezone(timedelta(hours=utc_offset))
+    day_start = 0  # messages before the first date line are stamped relative to the epoch
+
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith('--- '):
+            date_match = irssi_day_changed.match(line) or irssi_log_opened.match(line)
+
+            if date_match is not None:
+                month, day, year = date_match.groups()
+                try:
+                    day_start = _day_timestamp(int(year), months[month.lower()], int(day), tz)
+                except (KeyError, ValueError):
+                    date_str = '%s %s %s %s' % (month, day, year, _utc_offset_padded(utc_offset))
+                    day_start = int(datetime.strptime(date_str, '%b %d %Y %z').timestamp())
+                continue
+
+        match = irssi_message.match(line)
+
+        if match is None:
+            continue
+
+        hour, minute, author, message = match.groups()
+        yield day_start + int(hour) * 3600 + int(minute) * 60, author, message
+
+
+def parse_hexchat(lines, utc_offset=0):
+    """yields (timestamp, author, message) for every message line in a hexchat log"""
+    tz = timezone(timedelta(hours=utc_offset))
+    year = 1970
+    day_starts = {}  # (year, 'jan 01') -> timestamp, so each day is only converted once
+
+    for line in lines:
+        line = line.strip()
+
+        if line.startswith('****'):
+            year_match = hexchat_begin.match(line)
+
+            if year_match is not None:
+                year = int(year_match.group(1))
+                continue
+
+        match = hexchat_message.match(line)
+
+        if match is None:
+            continue
+
+        stamp, author, message = match.groups()
+
+        try:
+            key = (year, stamp[:6])
+            if key not in day_starts:
+                day_starts[key] = _day_timestamp(year, months[stamp[:3].lower()], int(stamp[4:6]), tz)
+            hours, minutes, seconds = stamp[7:].split(':')
+            timestamp = day_starts[key] + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        except (KeyError, ValueError):
+            # anything unusual goes through the slow, exact path
+            log_time = datetime.strptime('%s %i %s' % (stamp, year, _utc_offset_padded(utc_offset)), '%b %d %X %Y %z')
+            timestamp = int(log_time.timestamp())
+
+        yield timestamp, author, message
+
+
+# parser, and what a line that resets the parser's date must start with
+log_formats = {
+    'irssi': (parse_irssi, ('--- Day changed', '--- Log opened')),
+    'hexchat': (parse_hexchat, ('**** BEGIN LOGGING AT',))
+}
+
+
+class ImportProgress:
+    def __init__(self):
+        self.lines = 0
+        self.messages = 0
+        self.started = time.time()
+        self.next_report = progress_interval
+
+    def lines_per_second(self):
+        elapsed = time.time() - self.started
+        return self.lines / elapsed if elapsed > 0 else 0
+
+    def add_lines(self, count):
+        self.lines += count
+
+        if self.lines >= self.next_report:
+            print('processing line %i (%i lines/s)' % (self.lines, self.lines_per_second()))
+            self.next_report = (self.lines // progress_interval + 1) * progress_interval
+
+    def count_lines(self, lines):
+        for line in lines:
+            self.add_lines(1)
+            yield line
+
+    def count_messages(self, rows):
+        for row in rows:
+            self.messages += 1
+            yield row
+
+
+def _chunks(lines, boundaries):
+    # split only where the date is reset, so every chunk after the first can be parsed on its own
+    chunk = []
+    for line in lines:
+        if len(chunk) >= chunk_lines and line.startswith(boundaries):
+            yield chunk
+            chunk = []
+        chunk.append(line)
+
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _parse_chunk(args):
+    log_format, chunk, utc_offset = args
+    parser, _ = log_formats[log_format]
+    return len(chunk), list(parser(chunk, utc_offset))
+
+
+def _parse_parallel(log, log_format, utc_offset, processes, progress):
+    _, boundaries = log_formats[log_format]
+    jobs = ((log_format, chunk, utc_offset) for chunk in _chunks(log, boundaries))
+
+    # a bounded window instead of imap, so the workers can't parse the whole archive into memory while the
+    # single inserting thread falls behind, results are taken oldest first to keep the file order
+    with Pool(processes) as pool:
+        pending = deque()
+
+        for job in jobs:
+            pending.append(pool.apply_async(_parse_chunk, (job,)))
+
+            if len(pending) >= processes * chunks_in_flight:
+                line_count, rows = pending.popleft().get()
+                progress.add_lines(line_count)
+                yield from rows
+
+        while len(pending) > 0:
+            line_count, rows = pending.popleft().get()
+            progress.add_lines(line_count)
+            yield from rows
+
+
+def import_log(database, filename, channel, log_format, utc_offset=0, processes=1):
+    # serial by default, the parsing processes only pay off once parsing rather than inserting is the bottleneck
+    parser, _ = log_formats[log_format]
+    progress = ImportProgress()
+
+    with open(filename, 'r', encoding='utf-8') as log:
+        if processes > 1:
+            rows = _parse_parallel(log, log_format, utc_offset, processes, progress)
+        else:
+            rows = parser(progress.count_lines(log), utc_offset)
+
+        imported, skipped = database.import_quotes(channel, progress.count_messages(rows))
+
+    print('Imported %i messages' % imported)
+    print('Skipped %i messages' % skipped)
+    print('%i messages total' % progress.messages)
+    print('%i lines total (%i lines/s)' % (progress.lines, progress.lines_per_second()))
+
+    return imported, skipped
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+
+class LogWriter:
+    """
+    Appends log lines to a file (and/or echoes them to a stream like stdout) from a background thread, so logging a
+    line is a queue put instead of an open/write/close on the caller's thread. Lines are written in batches with one
+    flush per batch, and the file is kept open and rotated once it gets too big or too old.
+    When the queue is full new lines are dropped (and counted) unless block is set, then the caller waits instead.
+    """
+    queue_size = 10000    # lines waiting to be written before dropping/blocking kicks in
+    batch_size = 500      # most lines written per flush
+    flush_interval = 0.5  # how long the writer waits for more lines before flushing what it has
+    max_bytes = None      # rotate once the file would grow past this, None to never rotate on size
+    rotate_interval = None  # seconds between rotations, None to never rotate on time
+    backups = 3           # rotated files to keep as file.1 (newest) to file.<backups>
+
+    def __init__(self, filename=None, stream=None, level=DEBUG, newline='\r\n', max_bytes=None, rotate_interval=None,
+                 backups=None, queue_size=None, block=False):
+        self.filename = filename  # None to only echo to the stream
+        self.stream = stream
+        self.level = levels.get(level, DEBUG) if isinstance(level, str) else level
+        self.newline = newline
+        self.max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        self.rotate_interval = rotate_interval if rotate_interval is not None else self.rotate_interval
+        self.backups = backups if backups is not None else self.backups
+        self.block = block
+        self.queue = queue.Queue(queue_size if queue_size is not None else self.queue_size)
+        self.file = None
+        self.opened = 0
+        self.written = 0
+        self.dropped = 0
+        self.dropped_reported = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # the thread is a daemon, whatever is still queued at exit would be lost
+
+    def write(self, line, level=INFO):
+        """queues a line, returns False if it was filtered out or dropped"""
+        if level < self.level:
+            return False
+
+        try:
+            self.queue.put(line, block=self.block)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def flush(self):
+        """blocks until every line queued so far has been written, e.g. before the process is replaced"""
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """writes everything that is still queued and stops the writer thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)  # always blocks, the last lines shouldn't get lost
+            self.thread.join()
+
+    def stats(self):
+        return 'written=%i dropped=%i queued=%i' % (self.written, self.dropped, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # collect whatever else arrives shortly after, so a burst of lines turns into one write
+            while len(lines) < self.batch_size and lines[-1] is not None:
+                try:
+                    lines.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            taken = len(lines)  # for task_done, which flush() waits on
+            stop = lines[-1] is None
+            if stop:
+                lines.pop()
+
+            with self.lock:
+                dropped = self.dropped - self.dropped_reported
+                self.dropped_reported = self.dropped
+            if dropped > 0:
+                lines.append('[log] dropped %i lines, the log queue was full' % dropped)
+
+            try:
+                self._write(lines)
+            except Exception as error:  # the writer thread has to survive anything, or every later line is lost
+                print('Couldn\'t write log to %s (%s): %s' % (self.filename, str(type(error)), error.args), file=sys.stderr)
+                self._close_file()
+
+            for _ in range(taken):
+                self.queue.task_done()
+
+            if stop:
+                self._close_file()
+                return
+
+    def _write(self, lines):
+        if len(lines) == 0:
+            return
+
+        if self.stream is not None:
+            self.stream.write(''.join('%s\n' % line for line in lines))
+            self.stream.flush()
+
+        if self.filename is not None:
+            data = ''.join('%s%s' % (line, self.newline) for line in lines)
+            self._rotate_if_needed(len(data.encode('utf-8')))
+
+            if self.file is None:
+                self.file = open(self.filename, 'a', encoding='utf-8', newline='')
+                self.opened = time.time()
+
+            self.file.write(data)
+            self.file.flush()
+
+        self.written += len(lines)
+
+    def _rotate_if_needed(self, size):
+        if self.file is not None:
+            current_size = self.file.tell()
+        else:
+            current_size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        too_big = self.max_bytes is not None and current_size > 0 and current_size + size > self.max_bytes
+        too_old = self.rotate_interval is not None and self.file is not None \
+            and time.time() - self.opened >= self.rotate_interval
+
+        if not too_big and not too_old:
+            return
+
+        self._close_file()
+
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists('%s.%i' % (self.filename, i)):
+                    os.replace('%s.%i' % (self.filename, i), '%s.%i' % (self.filename, i + 1))
+            if os.path.exists(self.filename):
+                os.replace(self.filename, '%s.1' % self.filename)
+        elif os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
@@ -0,0 +1,44 @@
+import threading
+
+
+class Histogram:
+    """a fixed-bucket histogram of durations in seconds, cheap enough to record on every call"""
+    default_bounds = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds if bounds is not None else self.default_bounds
+        self.buckets = [0] * (len(self.bounds) + 1)  # the last bucket holds everything above the highest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            i = 0
+            while i < len(self.bounds) and value > self.bounds[i]:
+                i += 1
+            self.buckets[i] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p):
+        # upper bound of the bucket that the p-th percentile falls into, close enough for spotting slow paths
+        with self.lock:
+            rank = p / 100 * self.count
+            seen = 0
+            for i, count in enumerate(self.buckets):
+                seen += count
+                if seen >= rank and count > 0:
+                    return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def summary(self):
+        if self.count == 0:
+            return 'no samples'
+        return 'n=%i avg=%.3fs p50<=%gs p95<=%gs max=%.3fs' \
+               % (self.count, self.mean(), self.percentile(50), self.percentile(95), self.max)
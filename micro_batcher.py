@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import Future, wait
+
+
+class MicroBatcher:
+    """
+    Collects keys that are asked for from different threads within a short window and resolves them with a single
+    call, e.g. one youtube api request for all video ids pasted in any channel around the same time.
+    resolve(keys) returns a dict of key => value, keys it leaves out resolve to None.
+    """
+    window = 0.1    # seconds to wait for more keys after the first one arrives
+    max_batch = 50  # resolve right away once this many keys are waiting
+    timeout = 15    # seconds a caller waits for its batch before giving up
+
+    def __init__(self, resolve, window=None, max_batch=None, log=None):
+        self.resolve = resolve
+        self.window = window if window is not None else self.window
+        self.max_batch = max_batch if max_batch is not None else self.max_batch
+        self.log = log if log is not None else print
+        self.pending = {}  # key => Future, in arrival order
+        self.timer = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.keys = 0
+
+    def get(self, keys):
+        """blocks until every key is resolved and returns a dict of key => value"""
+        futures = {}
+        full = False
+
+        with self.lock:
+            for key in keys:
+                if key not in self.pending:
+                    self.pending[key] = Future()  # someone else may already be waiting for the same key
+                futures[key] = self.pending[key]
+
+            if len(self.pending) >= self.max_batch:
+                full = True
+            elif self.timer is None and len(self.pending) > 0:
+                self.timer = threading.Timer(self.window, self._flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full:
+            self._flush()
+
+        wait(futures.values(), timeout=self.timeout)
+        return {key: future.result() if future.done() else None for key, future in futures.items()}
+
+    def stats(self):
+        average = self.keys / self.batches if self.batches > 0 else 0
+        return 'batches=%i keys=%i avg_batch=%.1f' % (self.batches, self.keys, average)
+
+    def _flush(self):
+        while True:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+                if len(self.pending) == 0:
+                    return
+
+                keys = list(self.pending)[:self.max_batch]
+                batch = {key: self.pending.pop(key) for key in keys}
+                self.batches += 1
+                self.keys += len(keys)
+
+            try:
+                results = self.resolve(keys)
+            except Exception as error:
+                self.log('Batch of %i failed (%s): %s' % (len(keys), str(type(error)), error.args))
+                results = {}
+
+            for key, future in batch.items():
+                future.set_result(results.get(key, None))
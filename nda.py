@@ -3,8 +3,6 @@
 import time
 import json
 import re
-import sqlite3
-import random
 from datetime import datetime, timezone
 from redis import StrictRedis
 from twitter import Twitter
@@ -14,11 +12,48 @@ import greetings
 from irc import IRC
 from link_generator import LinkGenerator
 from link_lookup import LinkLookup
+from link_buffer import LinkBuffer
+from canned_responses import CannedResponses
+from trigger_scanner import TriggerScanner
+from ttl_cache import TTLCache
+from http_client import HttpClient
 from idle_talk import IdleTimer
 from database import Database
 from maze import Maze
 from rpg.main import RPG
-from util import clamp, is_channel
+from util import AliasMap, clamp, is_channel
+from commands import CommandContext, CommandRegistry
+from work_pool import WorkPool
+
+quote_multiword_search = re.compile(r'\?"(.*)"')
+quote_singleword_search = re.compile(r'\?([^\s]+)')
+quote_year = re.compile(r'^\d{4}$')
+
+
+def parse_quote_args(raw_args):
+    """splits the arguments of the !quote family into (author, year, search)"""
+    author = None
+    year = None
+    search = ''
+    raw_args_nosearch = raw_args
+
+    multiword_match = quote_multiword_search.search(raw_args)
+    singleword_match = quote_singleword_search.search(raw_args)
+
+    if multiword_match is not None:
+        search = multiword_match.group(1)
+        raw_args_nosearch = raw_args.replace('?"' + search + '"', '')
+    elif singleword_match is not None:
+        search = singleword_match.group(1)
+        raw_args_nosearch = raw_args.replace('?' + search, '')
+
+    for arg in raw_args_nosearch.split():
+        if quote_year.match(arg) is not None:
+            year = int(arg)
+        else:
+            author = arg
+
+    return author, year, search if len(search) > 0 else None
 
 
 class Channel:
@@ -30,6 +65,7 @@ class Channel:
         self.game = Maze()
         self.rpg = RPG(name)
         self.history = []
+        self.idle_job = None
 
     def add_history(self, description, detail):
         self.history.append((description, detail))
@@ -44,13 +80,18 @@ class Channel:
 class NDA(IRC):
     passive_interval = 60  # how long between performing passive, input independent operations like mail
     admin_duration = 30    # how long an admin session is active after authenticating with !su
+    redis_interval = 0.5   # how often to check redis for external input
+    deliver_interval = 5   # how often to drop background jobs that missed their deadline
     redis_in_prefix = 'ndain:'
     redis_out_prefix = 'ndaout:'
+    commands = CommandRegistry('!')  # explicit commands, filled in by the @commands.command decorators below
 
     def __init__(self, conf_file):
         with open(conf_file, 'r', encoding='utf-8') as f:
             conf = json.load(f)
 
+        self.conf_file = conf_file
+
         super().__init__(
             conf['address'],
             conf.get('port', 6667),
@@ -58,25 +99,39 @@ class NDA(IRC):
             conf['real_name'],
             conf['nicks'],
             conf.get('nickserv_password', None),
-            conf.get('logging', False)
+            conf.get('logging', False),
+            conf.get('irc_engine', 'select')
         )
 
         self.channels = [Channel(c) for c in conf['channels']]
         self.admin_password = conf.get('admin_password', '')
         self.idle_talk = conf.get('idle_talk', False)
-        self.auto_tweet_regex = conf.get('auto_tweet_regex', None)
-        self.admin_sessions = {}
-        self.last_passive = datetime.min
+        auto_tweet_regex = conf.get('auto_tweet_regex', None)
+        self.auto_tweet_regex = re.compile(auto_tweet_regex) if auto_tweet_regex is not None else None
+        self.admin_sessions = {}  # nick => the job that ends the session
+        self.connection_jobs = []  # scheduled jobs that only make sense while connected
+        self.greetings = greetings.GreetingSchedule(log=self.log)
+        self.greet_job = None
+        self.aliases = AliasMap(conf.get('aliases', {}))  # shared with the database so both normalize nicks the same way
 
         self.database = Database(
             'nda.db',
-            conf.get('aliases', {}),
-            conf.get('ignore_nicks', [])
+            self.aliases,
+            conf.get('ignore_nicks', []),
+            conf.get('database', {})
+        )
+        http = conf.get('http', {})
+        self.http = HttpClient(
+            http.get('pool_connections', None),
+            http.get('pool_maxsize', None),
+            http.get('retries', None),
+            http.get('backoff_factor', None)
         )
         self.link_gen = LinkGenerator(
             conf.get('reddit_consumer_key', None),
             conf.get('reddit_consumer_secret', None),
-            conf.get('pastebin_api_key', None)
+            conf.get('pastebin_api_key', None),
+            self.http
         )
         self.twitter = Twitter(
             conf.get('twitter_consumer_key', None),
@@ -84,10 +139,43 @@ class NDA(IRC):
             conf.get('twitter_access_token', None),
             conf.get('twitter_access_token_secret', None)
         )
+        link_cache = conf.get('link_cache', {})
         self.link_lookup = LinkLookup(
             conf.get('youtube_api_key', None),
-            self.twitter
+            self.twitter,
+            TTLCache(
+                link_cache.get('max_entries', None),
+                link_cache.get('ttl', None),
+                link_cache.get('negative_ttl', None),
+                link_cache.get('file', None)  # keeps the cache across restarts, e.g. !update
+            ),
+            self.http
+        )
+        link_buffer = conf.get('link_buffer', {})
+        self.link_buffer = LinkBuffer(
+            {
+                'imgur': self.link_gen.imgur,
+                'reddit': self.link_gen.reddit,
+                'wikihow': self.link_gen.wikihow,
+                'xhamster': self.link_gen.xhamster,
+                'penis': self.link_gen.penis
+            },
+            link_buffer.get('size', None),
+            link_buffer.get('max_age', None),
+            self.log
+        )
+        self.canned_responses = CannedResponses(self.log)
+        self.canned_responses.load(conf.get('canned_responses', [
+            {'trigger': 'undertale', 'file': 'ndrtl.db', 'table': 'undertale'}
+        ]))
+        self.trigger_scanner = TriggerScanner(self.canned_responses.responses)
+        self.work_pool = WorkPool(  # http lookups and uploads run here, off the irc loop
+            conf.get('workers', None),
+            self.log,
+            lambda: self.scheduler.call_later(0, self.work_pool.deliver)  # post results as soon as they're ready
         )
+        self.scheduler.call_every(self.deliver_interval, self.work_pool.deliver)
+        self.scheduler.call_every(self.database.commit_interval, self.database.flush_if_due)  # buffered quotes and last seen
 
         use_redis = conf.get('use_redis', False)
         self.redis, self.redis_sub = None, None
@@ -105,14 +193,37 @@ class NDA(IRC):
         for channel in self.channels:
             self.send_message(channel.name, 'tell proog that a %s occurred :\'(' % str(type(error)))
 
+    def started(self):
+        self.link_buffer.start()
+
     def stopped(self):
+        self.link_buffer.stop()
+        self.work_pool.shutdown()
+        self.link_gen.prober.shutdown()
+        self.link_lookup.cache.close()
+        self.http.close()
         self.database.close()
         if self.redis_sub is not None:
             self.redis_sub.close()
 
     def connected(self):
+        for job in list(self.admin_sessions.values()) + self.connection_jobs + [c.idle_job for c in self.channels]:
+            self.scheduler.cancel(job)
+        self.scheduler.cancel(self.greet_job)
+
         self.admin_sessions = {}
-        self.last_passive = datetime.utcnow()
+        self.connection_jobs = []
+        self.schedule_greeting()
+
+        if self.redis_sub is not None:
+            self.connection_jobs.append(self.scheduler.call_every(self.redis_interval, self.redis_input))
+
+        # check if any nicks with unread messages have come online (disabled for now)
+        # self.connection_jobs.append(self.scheduler.call_every(self.passive_interval, self.check_unread_mail))
+
+        if self.idle_talk:
+            for channel in self.channels:
+                self.schedule_idle_talk(channel)
 
         for channel in self.channels:
             self._join(channel.name)
@@ -127,40 +238,47 @@ class NDA(IRC):
             timestamp = int(datetime.now(timezone.utc).timestamp())
             self.database.add_quote(to, timestamp, self.current_nick(), message, full_only=True)
 
-    def main_loop_iteration(self):
-        # check for external input
-        self.redis_input()
-
-        # perform various passive operations if the interval is up
-        if (datetime.utcnow() - self.last_passive).total_seconds() < self.passive_interval:
-            return
-
-        # check if any nicks with unread messages have come online (disabled for now)
-        # unread_receivers = self.database.mail_unread_receivers()
-        # if len(unread_receivers) > 0:
-        #     self._ison(unread_receivers)
-
-        # check if it's time to talk
-        if self.idle_talk:
-            for channel in self.channels:
-                if channel.idle_timer.can_talk():
-                    seq_id = 0
-                    quote = self.database.random_quote(channel=channel.name, stringify=False)
-                    if quote is not None:
-                        message, author, date, seq_id = quote
-                        self.send_message(channel.name, message)
-                    channel.add_history('idle talk', 'seq_id=%i, i=%i, d=%i'
-                                        % (seq_id, channel.idle_timer.interval, channel.idle_timer.delay))
-                    channel.idle_timer.message_sent()  # notify idle timer that we sent something, even with no quote
-
+    def talk_when_idle(self, channel):
+        try:
+            if channel.idle_timer.can_talk():
+                seq_id = 0
+                quote = self.database.random_quote(channel=channel.name, stringify=False)
+                if quote is not None:
+                    message, author, date, seq_id = quote
+                    self.send_message(channel.name, message)
+                channel.add_history('idle talk', 'seq_id=%i, i=%i, d=%i'
+                                    % (seq_id, channel.idle_timer.interval, channel.idle_timer.delay))
+                channel.idle_timer.message_sent()  # notify idle timer that we sent something, even with no quote
+        finally:
+            self.schedule_idle_talk(channel)
+
+    def schedule_idle_talk(self, channel):
+        # someone talking in the meantime pushes the time back, then the job just looks again when it's actually up
+        delay = max(channel.idle_timer.seconds_until_talk(), 1)
+        channel.idle_job = self.scheduler.call_later(delay, lambda: self.talk_when_idle(channel), 'idle talk %s' % channel.name)
+
+    def greet(self):
         # check if it's time for a festive greeting
-        for channel_name, greeting in greetings.greet():
-            channel = self.get_channel(channel_name)
-            if channel is not None:
-                self.send_message(channel_name, greeting)
-                channel.add_history('greeting', greeting)
-
-        self.last_passive = datetime.utcnow()
+        try:
+            for channel_name, greeting in self.greetings.greet():
+                channel = self.get_channel(channel_name)
+                if channel is not None:
+                    self.send_message(channel_name, greeting)
+                    channel.add_history('greeting', greeting)
+        finally:
+            self.schedule_greeting()
+
+    def schedule_greeting(self):
+        # wake up for the next greeting, or after passive_interval at the latest to notice edits to greetings.conf
+        self.greetings.reload_if_changed()
+        delay = self.greetings.seconds_until_next()
+        delay = self.passive_interval if delay is None else min(max(delay, 1), self.passive_interval)
+        self.greet_job = self.scheduler.call_later(delay, self.greet)
+
+    def check_unread_mail(self):
+        unread_receivers = self.database.mail_unread_receivers()
+        if len(unread_receivers) > 0:
+            self._ison(unread_receivers)
 
     def nick_seen(self, nick):
         self.database.update_last_seen(nick)
@@ -174,23 +292,18 @@ class NDA(IRC):
 
     def message_received(self, message, reply_target, source_nick):
         channel = self.get_channel(reply_target)
-        tokens = message.split()
-        _, _, raw_args = message.partition(' ')
 
         # redis logging
         if self.redis is not None:
             self.redis.publish('%s%s' % (self.redis_out_prefix, reply_target), message)
 
-        if len(tokens) == 0:
+        if len(message.strip()) == 0:
             return  # don't process empty or whitespace-only messages
 
-        if message.startswith(' '):
-            tokens[0] = ' ' + tokens[0]  # any initial space is removed by str.split(), so we put it back here
-
-        # explicit commands
-        command = tokens[0]
-        args = tokens[1:] if len(tokens) > 1 else []
-        handled = self.explicit_command(command, args, reply_target, source_nick, raw_args)
+        # explicit commands, only messages that start with the prefix can be one so everything else skips the lookup
+        handled = False
+        if message.startswith(self.commands.prefix):
+            handled = self.explicit_command(message, reply_target, source_nick)
 
         if channel is not None:
             channel.idle_timer.message_received()  # notify idle timer that someone talked
@@ -201,346 +314,334 @@ class NDA(IRC):
         if not handled:
             self.implicit_command(message, reply_target, source_nick)
 
-    def explicit_command(self, command, args, reply_target, source_nick, raw_args):
-        channel = self.get_channel(reply_target)
-
-        def parse_quote_command():
-            author = None
-            year = None
-            search = ''
-            raw_args_nosearch = raw_args
-
-            multiword_match = re.search(r'\?"(.*)"', raw_args)
-            singleword_match = re.search(r'\?([^\s]+)', raw_args)
-
-            if multiword_match is not None:
-                search = multiword_match.group(1)
-                raw_args_nosearch = raw_args.replace('?"' + search + '"', '')
-            elif singleword_match is not None:
-                search = singleword_match.group(1)
-                raw_args_nosearch = raw_args.replace('?' + search, '')
-
-            for arg in raw_args_nosearch.split():
-                if re.match(r'^\d{4}$', arg) is not None:
-                    year = int(arg)
-                else:
-                    author = arg
-
-            return author, year, search if len(search) > 0 else None
-
-        def admin(func):
-            if self.is_admin(source_nick):
-                func()
-            else:
-                self.send_message(reply_target, 'how about no >:(')
-
-        def uptime():
-            connect_time = self.connect_time.strftime('%Y-%m-%d %H:%M:%S')
-            uptime_str = str(datetime.utcnow() - self.connect_time)
-            self.send_message(reply_target, 'connected on %s, %s ago' % (connect_time, uptime_str))
-
-        def porn():
-            link = self.link_gen.xhamster()
-            self.send_message(reply_target, link)
-            if link.startswith('http://') or link.startswith('https://'):
-                comment = self.link_lookup.xhamster_comment(link)
-                self.send_message(reply_target, comment)
-
-        def quote():
-            if channel is None:  # only allow quote requests in a channel
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
+    def explicit_command(self, message, reply_target, source_nick):
+        name, _, raw_args = message.partition(' ')
+        command = self.commands.get(name.lower())
 
-            author, year, word = parse_quote_command()
-            random_quote = self.database.random_quote(reply_target, author, year, word)
-            self.send_message(reply_target, random_quote if random_quote is not None else 'no quotes found :(')
-            channel.add_history('quote', 'a=%s, y=%s, w=%s' % (author, year, word))
+        if command is None:
+            return False
 
-        def quote_id():
-            if channel is None:  # only allow quote requests in a channel
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
-            if len(args) < 1:
-                self.send_message(reply_target, 'missing sequence id :(')
-                return
-
-            try:
-                seq_id = int(args[0])
-            except ValueError:
-                self.send_message(reply_target, 'bad sequence id :(')
-                return
-
-            quote = self.database.quote_by_seq_id(reply_target, seq_id)
-            self.send_message(reply_target, quote if quote is not None else 'quote not found :(')
-
-        def quote_count():
-            if channel is None:
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
+        channel = self.get_channel(reply_target)
+        ctx = CommandContext(command.name, raw_args.split(), raw_args, message, reply_target, source_nick, channel)
 
-            author, year, word = parse_quote_command()
-            count = self.database.quote_count(reply_target, author, year, word)
-            self.send_message(reply_target, '%i quotes' % count)
-            channel.add_history('quote count', 'a=%s, y=%s, w=%s' % (author, year, word))
+        if command.admin and not self.is_admin(source_nick):
+            self.send_message(reply_target, 'how about no >:(')
+        elif command.channel_only and channel is None:
+            self.send_message(reply_target, 'command only available in channel :(')
+        else:
+            self.commands.run(command, self, ctx)
 
-        def quote_top(percent=False):
-            if channel is None:
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
+        return True
 
-            author, year, word = parse_quote_command()
-            func = self.database.quote_top_percent if percent else self.database.quote_top
-            top = func(reply_target, 5, year, word)
-            channel.add_history('quote top', 'y=%s, w=%s, pct=%s' % (year, word, percent))
-            if len(top) > 0:
-                self.send_messages(reply_target, top)
-            else:
-                self.send_message(reply_target, 'no quotes found :(')
-
-        def quote_context():
-            if channel is None:
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
+    @commands.command('!context', channel_only=True)
+    def quote_context(self, ctx):
+        if len(ctx.args) < 1:
+            self.send_message(ctx.reply_target, 'missing sequence id :(')
+            return
 
-            if len(args) < 1:
-                self.send_message(reply_target, 'missing sequence id :(')
-                return
+        try:
+            seq_id = int(ctx.args[0])
+        except ValueError:
+            self.send_message(ctx.reply_target, 'bad sequence id :(')
+            return
 
+        lines = 20
+        if len(ctx.args) > 1:
             try:
-                seq_id = int(args[0])
+                lines = clamp(0, int(ctx.args[1]), 100)
             except ValueError:
-                self.send_message(reply_target, 'bad sequence id :(')
-                return
+                pass
 
-            lines = 20
-            if len(args) > 1:
-                try:
-                    lines = clamp(0, int(args[1]), 100)
-                except ValueError:
-                    pass
+        context = self.database.quote_context(ctx.reply_target, seq_id, lines)
 
-            context = self.database.quote_context(reply_target, seq_id, lines)
+        if len(context) == 0:
+            self.send_message(ctx.reply_target, 'no context found :(')
+            return
 
-            if len(context) == 0:
-                self.send_message(reply_target, 'no context found :(')
-                return
+        def uploaded(link):
+            self.send_message(ctx.reply_target, link if link is not None else 'couldn\'t upload to pastebin :(')
+
+        self.in_background(ctx.reply_target, uploaded, self.link_gen.make_pastebin, '\r\n'.join(context))
+
+    @commands.command('!die', admin=True)
+    def die(self, ctx):
+        raise KeyboardInterrupt
+
+    @commands.command('!help')
+    def help(self, ctx):
+        self.send_messages(ctx.source_nick, [
+            '!context ID [NUM_LINES]: pastebin context for a quote, optionally with number of lines (default is 20)',
+            '!imgur: random imgur link',
+            '!isitmovienight: is it movie night?',
+            '!penis: random penis',
+            '!porn: random porn link + longest comment',
+            '!quote [NICK] [YEAR] [?SEARCH]: get a random quote and optionally filter by nick, year or search string. Search string can be enclosed in quotes (?"") to allow spaces',
+            '!quotecount [NICK] [YEAR] [?SEARCH]: same as !quote, but get total number of matches instead',
+            '!quotetop [YEAR] [?SEARCH]: get the top 5 nicks by number of quotes',
+            '!quotetopp [YEAR] [?SEARCH]: same as !quotetop, but use matching:total ratio instead of number of quotes',
+            '!reddit: random reddit link',
+            '!rpg [ACTION]: play the GOTY right here',
+            '!seen NICK: when did the bot last see NICK?',
+            '!settime UTC_OFFSET: set your timezone',
+            '!stats: send and work pool statistics, sent privately (admin only)',
+            '!time NICK: get current time and timezone for NICK',
+            '!tweet MESSAGE: send MESSAGE as tweet',
+            '!wikihow: random wikihow article',
+            # '!send NICK MESSAGE: deliver MESSAGE to NICK once it\'s online',
+            # '!outbox: see your messages that haven\'t been delivered yet',
+            # '!unsend ID: cancel delivery of message with the specified id (listed by !outbox)',
+        ])
+
+    @commands.command('!hi')
+    def hi(self, ctx):
+        self.send_message(ctx.reply_target, 'hi %s, jag heter %s, %s heter jag' % (ctx.source_nick, self.current_nick(), self.current_nick()))
+
+    @commands.command('!history')
+    def history(self, ctx):
+        history_channel = self.get_channel(ctx.args[0]) if len(ctx.args) > 0 else ctx.channel
+
+        if history_channel is None:
+            self.send_message(ctx.reply_target, 'channel not found, please specify #channel :(')
+            return
 
-            link = self.link_gen.make_pastebin('\r\n'.join(context))
-            self.send_message(reply_target, link if link is not None else 'couldn\'t upload to pastebin :(')
+        recent = history_channel.get_history(3)
+        if len(recent) == 0:
+            self.send_message(ctx.reply_target, 'No history yet :(')
+            return
+        self.send_messages(ctx.reply_target, ['%s: %s' % entry for entry in recent])
 
-        def update():
-            if shell.git_pull():
-                self._disconnect('if i\'m not back in a few seconds, something is wrong')
-                time.sleep(2)  # give the server time to process disconnection to prevent nick collision
-                shell.restart(__file__)
-            else:
-                self.send_message(reply_target, 'pull failed, manual update required :(')
+    @commands.command('!imgur')
+    def imgur(self, ctx):
+        self.buffered_link(ctx.reply_target, 'imgur', lambda link: self.send_message(ctx.reply_target, link))
 
-        def shell_command():
-            output = shell.run(' '.join(args))
-            self.send_messages(reply_target, output)
+    @commands.command('!isitmovienight')
+    def is_it_movie_night(self, ctx):
+        self.send_message(ctx.reply_target, 'maybe :)' if datetime.utcnow().weekday() in [4, 5] else 'no :(')
 
-        def rpg_action():
-            if channel is None:  # only allow rpg play in channel
-                self.send_message(reply_target, 'command only available in channel :(')
-                return
-            self.send_messages(reply_target, channel.rpg.action(' '.join(args)))
+    @commands.command('!penis')
+    def penis(self, ctx):
+        def found(link):
+            self.send_message(ctx.reply_target, link if link is not None else 'couldn\'t grab a dick for you, sorry :(')
 
-        def send_mail():
-            if len(args) < 2:
-                return
-            to = args[0]
-            msg = ' '.join(args[1:])
-            self.database.mail_send(source_nick, to, msg)
-            self.send_message(source_nick, 'message sent to %s :)' % to)
+        self.buffered_link(ctx.reply_target, 'penis', found)
 
-        def unsend_mail():
-            if len(args) < 1:
-                return
-            try:
-                id = int(args[0])
-                success = self.database.mail_unsend(source_nick, id)
-                self.send_message(source_nick, 'message %i unsent :)' % id if success else 'message %i wasn\'t found :(')
-            except ValueError:
-                pass
+    @commands.command('!porn')
+    def porn(self, ctx):
+        def found(link):
+            self.send_message(ctx.reply_target, link)
+            if link.startswith('http://') or link.startswith('https://'):
+                self.in_background(ctx.reply_target, lambda comment: self.send_message(ctx.reply_target, comment),
+                                   self.link_lookup.xhamster_comment, link)
+
+        self.buffered_link(ctx.reply_target, 'xhamster', found)
+
+    @commands.command('!quote', channel_only=True)
+    def quote(self, ctx):
+        author, year, word = parse_quote_args(ctx.raw_args)
+        random_quote = self.database.random_quote(ctx.reply_target, author, year, word)
+        self.send_message(ctx.reply_target, random_quote if random_quote is not None else 'no quotes found :(')
+        ctx.channel.add_history('quote', 'a=%s, y=%s, w=%s' % (author, year, word))
+
+    @commands.command('!quotecount', channel_only=True)
+    def quote_count(self, ctx):
+        author, year, word = parse_quote_args(ctx.raw_args)
+        count = self.database.quote_count(ctx.reply_target, author, year, word)
+        self.send_message(ctx.reply_target, '%i quotes' % count)
+        ctx.channel.add_history('quote count', 'a=%s, y=%s, w=%s' % (author, year, word))
+
+    @commands.command('!quoteid', channel_only=True)
+    def quote_id(self, ctx):
+        if len(ctx.args) < 1:
+            self.send_message(ctx.reply_target, 'missing sequence id :(')
+            return
 
-        def outbox():
-            messages = self.database.mail_outbox(source_nick)
-            if len(messages) == 0:
-                self.send_message(source_nick, 'no unsent messages')
-            else:
-                self.send_messages(source_nick, messages)
+        try:
+            seq_id = int(ctx.args[0])
+        except ValueError:
+            self.send_message(ctx.reply_target, 'bad sequence id :(')
+            return
 
-        def tweet():
-            if len(raw_args) > 140:
-                self.send_message(reply_target, 'tweet too long (%i characters) :(' % len(raw_args))
-                return
+        quote = self.database.quote_by_seq_id(ctx.reply_target, seq_id)
+        self.send_message(ctx.reply_target, quote if quote is not None else 'quote not found :(')
+
+    @commands.command('!quotetop', channel_only=True)
+    def quote_top(self, ctx):
+        self._quote_top(ctx, False)
+
+    @commands.command('!quotetopp', channel_only=True)
+    def quote_top_percent(self, ctx):
+        self._quote_top(ctx, True)
+
+    def _quote_top(self, ctx, percent):
+        author, year, word = parse_quote_args(ctx.raw_args)
+        func = self.database.quote_top_percent if percent else self.database.quote_top
+        top = func(ctx.reply_target, 5, year, word)
+        ctx.channel.add_history('quote top', 'y=%s, w=%s, pct=%s' % (year, word, percent))
+        if len(top) > 0:
+            self.send_messages(ctx.reply_target, top)
+        else:
+            self.send_message(ctx.reply_target, 'no quotes found :(')
+
+    @commands.command('!reddit')
+    def reddit(self, ctx):
+        self.buffered_link(ctx.reply_target, 'reddit', lambda link: self.send_message(ctx.reply_target, link))
+
+    @commands.command('!reloadaliases', admin=True)
+    def reload_aliases_command(self, ctx):
+        self.reload_aliases()
+        self.send_message(ctx.reply_target, 'aliases reloaded :)')
+
+    @commands.command('!rpg', channel_only=True)
+    def rpg_action(self, ctx):
+        self.send_messages(ctx.reply_target, ctx.channel.rpg.action(' '.join(ctx.args)))
+
+    @commands.command('!seen')
+    def seen(self, ctx):
+        if len(ctx.args) > 0:
+            self.send_message(ctx.reply_target, self.database.last_seen(ctx.args[0]))
+
+    @commands.command('!settime')
+    def set_time(self, ctx):
+        if len(ctx.args) > 0:
+            self.send_message(ctx.reply_target, self.database.set_current_time(ctx.source_nick, ctx.args[0]))
+        else:
+            self.send_message(ctx.reply_target, 'missing utc offset :(')
+
+    @commands.command('!stats', admin=True)
+    def stats_command(self, ctx):
+        # a dozen lines, in private so they don't flood the channel, and admin only so nobody can hog the send rate
+        self.send_messages(ctx.source_nick, self.stats())
+
+    @commands.command('!su')
+    def su(self, ctx):
+        if ctx.raw_args == self.admin_password:
+            nick = ctx.source_nick
+            self.scheduler.cancel(self.admin_sessions.get(nick, None))  # authenticating again starts a new session
+            self.admin_sessions[nick] = self.scheduler.call_later(
+                self.admin_duration, lambda: self.admin_sessions.pop(nick, None), 'admin %s' % nick)
+            self.send_message(ctx.source_nick, 'you are now authenticated for %i seconds' % self.admin_duration)
+        else:
+            self.send_message(ctx.source_nick, 'how about no >:(')
+
+    @commands.command('!time')
+    def get_time(self, ctx):
+        if len(ctx.args) > 0:
+            self.send_message(ctx.reply_target, self.database.current_time(ctx.args[0]))
+        else:
+            self.send_message(ctx.reply_target, 'missing nick :(')
+
+    @commands.command('!tweet')
+    def tweet(self, ctx):
+        if len(ctx.raw_args) > 140:
+            self.send_message(ctx.reply_target, 'tweet too long (%i characters) :(' % len(ctx.raw_args))
+            return
 
-            if self.twitter.tweet(raw_args):
-                self.send_message(reply_target, 'sent :)')
+        def sent(success):
+            if success:
+                self.send_message(ctx.reply_target, 'sent :)')
             else:
                 delay = self.twitter.next_tweet_delay()
                 reason = 'in %i seconds' % delay if delay > 0 else 'now, but something went wrong'
-                self.send_message(reply_target, 'not sent (next tweet available %s) :(' % reason)
+                self.send_message(ctx.reply_target, 'not sent (next tweet available %s) :(' % reason)
+
+        self.in_background(ctx.reply_target, sent, self.twitter.tweet, ctx.raw_args)
+
+    @commands.command('!update', admin=True)
+    def update(self, ctx):
+        if shell.git_pull():
+            self.database.flush()  # restarting replaces the process without going through stopped()
+            self._disconnect('if i\'m not back in a few seconds, something is wrong')
+            time.sleep(2)  # give the server time to process disconnection to prevent nick collision
+            self.logger.flush()  # same for the log lines still queued
+            shell.restart(__file__)
+        else:
+            self.send_message(ctx.reply_target, 'pull failed, manual update required :(')
+
+    @commands.command('!uptime')
+    def uptime(self, ctx):
+        connect_time = self.connect_time.strftime('%Y-%m-%d %H:%M:%S')
+        uptime_str = str(datetime.utcnow() - self.connect_time)
+        self.send_message(ctx.reply_target, 'connected on %s, %s ago' % (connect_time, uptime_str))
+
+    @commands.command('!wikihow')
+    def wikihow(self, ctx):
+        self.buffered_link(ctx.reply_target, 'wikihow', lambda link: self.send_message(ctx.reply_target, link))
+
+    # disabled commands, add them to the registry with @commands.command('!name') to bring them back
+
+    def send_mail(self, ctx):  # !send
+        if len(ctx.args) < 2:
+            return
+        to = ctx.args[0]
+        msg = ' '.join(ctx.args[1:])
+        self.database.mail_send(ctx.source_nick, to, msg)
+        self.send_message(ctx.source_nick, 'message sent to %s :)' % to)
 
-        def su():
-            if raw_args == self.admin_password:
-                self.admin_sessions[source_nick] = datetime.utcnow()
-                self.send_message(source_nick, 'you are now authenticated for %i seconds' % self.admin_duration)
-            else:
-                self.send_message(source_nick, 'how about no >:(')
+    def unsend_mail(self, ctx):  # !unsend
+        if len(ctx.args) < 1:
+            return
+        try:
+            id = int(ctx.args[0])
+            success = self.database.mail_unsend(ctx.source_nick, id)
+            self.send_message(ctx.source_nick, 'message %i unsent :)' % id if success else 'message %i wasn\'t found :(')
+        except ValueError:
+            pass
+
+    def outbox(self, ctx):  # !outbox
+        messages = self.database.mail_outbox(ctx.source_nick)
+        if len(messages) == 0:
+            self.send_message(ctx.source_nick, 'no unsent messages')
+        else:
+            self.send_messages(ctx.source_nick, messages)
+
+    def shell_command(self, ctx):  # !shell, admin only
+        output = shell.run(' '.join(ctx.args))
+        self.send_messages(ctx.reply_target, output)
+
+    # the maze game used to be bound to !up, !down, !left, !right, !look and !restart through Channel.game
 
-        def die():
-            raise KeyboardInterrupt
+    def implicit_command(self, message, reply_target, source_nick):
+        triggers = self.trigger_scanner.scan(message)  # every link and trigger word, in one pass over the message
 
-        def penis():
-            link = self.link_gen.penis()
-            self.send_message(reply_target, link if link is not None else 'couldn\'t grab a dick for you, sorry :(')
+        if len(triggers.youtube_ids) > 0:
+            self.lookup_titles(reply_target, self.link_lookup.youtube_titles, triggers.youtube_ids)
+        if len(triggers.tweet_ids) > 0:
+            self.lookup_titles(reply_target, self.link_lookup.tweets, triggers.tweet_ids)
+        if len(triggers.links) > 0:
+            self.lookup_titles(reply_target, self.link_lookup.link_titles, triggers.links)
+        for trigger in triggers.canned:
+            self.send_message(reply_target, self.canned_responses.pick(trigger))
 
-        def set_time():
-            if len(args) > 0:
-                self.send_message(reply_target, self.database.set_current_time(source_nick, args[0]))
-            else:
-                self.send_message(reply_target, 'missing utc offset :(')
+        tweeted = self.tweet_trigger(message)
+        if tweeted:
+            self.in_background(reply_target, None, self.twitter.tweet, message, quiet=True)
 
-        def get_time():
-            if len(args) > 0:
-                self.send_message(reply_target, self.database.current_time(args[0]))
-            else:
-                self.send_message(reply_target, 'missing nick :(')
+        # if unit_converter.contains_unit(message):
+        #     self.convert_units(message, reply_target)
 
-        def history():
-            history_channel = self.get_channel(args[0]) if len(args) > 0 else channel
+        return bool(triggers) or tweeted
 
-            if history_channel is None:
-                self.send_message(reply_target, 'channel not found, please specify #channel :(')
-                return
+    def lookup_titles(self, reply_target, lookup, keys):
+        self.in_background(reply_target, lambda titles: self.send_titles(reply_target, titles), lookup, keys, quiet=True)
 
-            recent = history_channel.get_history(3)
-            if len(recent) == 0:
-                self.send_message(reply_target, 'No history yet :(')
-                return
-            self.send_messages(reply_target, ['%s: %s' % entry for entry in recent])
-
-        def help():
-            self.send_messages(source_nick, [
-                '!context ID [NUM_LINES]: pastebin context for a quote, optionally with number of lines (default is 20)',
-                '!imgur: random imgur link',
-                '!isitmovienight: is it movie night?',
-                '!penis: random penis',
-                '!porn: random porn link + longest comment',
-                '!quote [NICK] [YEAR] [?SEARCH]: get a random quote and optionally filter by nick, year or search string. Search string can be enclosed in quotes (?"") to allow spaces',
-                '!quotecount [NICK] [YEAR] [?SEARCH]: same as !quote, but get total number of matches instead',
-                '!quotetop [YEAR] [?SEARCH]: get the top 5 nicks by number of quotes',
-                '!quotetopp [YEAR] [?SEARCH]: same as !quotetop, but use matching:total ratio instead of number of quotes',
-                '!reddit: random reddit link',
-                '!rpg [ACTION]: play the GOTY right here',
-                '!seen NICK: when did the bot last see NICK?',
-                '!settime UTC_OFFSET: set your timezone',
-                '!time NICK: get current time and timezone for NICK',
-                '!tweet MESSAGE: send MESSAGE as tweet',
-                '!wikihow: random wikihow article',
-                # '!send NICK MESSAGE: deliver MESSAGE to NICK once it\'s online',
-                # '!outbox: see your messages that haven\'t been delivered yet',
-                # '!unsend ID: cancel delivery of message with the specified id (listed by !outbox)',
-            ])
-
-        command = command.lower()
-        commands = {
-            '!context': quote_context,
-            '!die': lambda: admin(die),
-            '!help': help,
-            '!hi': lambda: self.send_message(reply_target, 'hi %s, jag heter %s, %s heter jag' % (source_nick, self.current_nick(), self.current_nick())),
-            '!history': history,
-            '!imgur': lambda: self.send_message(reply_target, self.link_gen.imgur()),
-            '!isitmovienight': lambda: self.send_message(reply_target, 'maybe :)' if datetime.utcnow().weekday() in [4, 5] else 'no :('),
-            '!penis': penis,
-            '!porn': porn,
-            '!quote': quote,
-            '!quotecount': quote_count,
-            '!quoteid': quote_id,
-            '!quotetop': quote_top,
-            '!quotetopp': lambda: quote_top(True),
-            '!reddit': lambda: self.send_message(reply_target, self.link_gen.reddit()),
-            '!rpg': rpg_action,
-            '!seen': lambda: self.send_message(reply_target, self.database.last_seen(args[0])) if len(args) > 0 else None,
-            '!settime': set_time,
-            '!su': su,
-            '!time': get_time,
-            '!tweet': tweet,
-            '!update': lambda: admin(update),
-            '!uptime': uptime,
-            '!wikihow': lambda: self.send_message(reply_target, self.link_gen.wikihow()),
-            # '!send': send_mail,
-            # '!unsend': unsend_mail,
-            # '!outbox': outbox,
-            # '!shell': lambda: admin(shell_command),
-            # '!up': lambda: self._send_multiline_message(reply_target, self.game.up()),
-            # '!down': lambda: self._send_multiline_message(reply_target, self.game.down()),
-            # '!left': lambda: self._send_multiline_message(reply_target, self.game.left()),
-            # '!right': lambda: self._send_multiline_message(reply_target, self.game.right()),
-            # '!look': lambda: self._send_multiline_message(reply_target, self.game.look()),
-            # '!restart': lambda: self._send_multiline_message(reply_target, self.game.restart())
-        }
-
-        if command in commands:
-            commands[command]()
-            return True
-
-        return False
+    def send_title(self, reply_target, title):
+        if title is not None:
+            self.send_message(reply_target, '^^ \x02%s\x02' % title)  # 0x02 == control character for bold text
 
-    def implicit_command(self, message, reply_target, source_nick):
-        def youtube_lookup():
-            title = self.link_lookup.youtube(message)
-            if title is not None:
-                self.send_message(reply_target, '^^ \x02%s\x02' % title)  # 0x02 == control character for bold text
-
-        def twitter_lookup():
-            title = self.link_lookup.twitter(message)
-            if title is not None:
-                self.send_message(reply_target, '^^ \x02%s\x02' % title)
-
-        def generic_lookup():
-            title = self.link_lookup.generic(message)
-            if title is not None:
-                self.send_message(reply_target, '^^ \x02%s\x02' % title)
-
-        def convert_units():
-            converted = unit_converter.convert_unit(message)
-            if converted is not None:
-                value, unit = converted
-                self.send_message(reply_target, '^^ %.2f %s' % (value, unit))
-
-        def tweet_trigger():
-            m = message.lower()
-            return self.auto_tweet_regex is not None \
-                and len(m) in range(40, 141) \
-                and re.search(self.auto_tweet_regex, m) is not None
-
-        def undertale():
-            db = sqlite3.connect('ndrtl.db')
-            count, = db.execute('SELECT COUNT(*) FROM undertale').fetchone()
-            if count > 0:
-                msg, = db.execute('SELECT message FROM undertale WHERE id=?', (random.randint(1, count),)).fetchone()
-                self.send_message(reply_target, msg)
-            db.close()
-
-        matched = False
-        matchers = [
-            ((lambda: self.link_lookup.contains_youtube(message)), youtube_lookup),
-            ((lambda: self.link_lookup.contains_twitter(message)), twitter_lookup),
-            ((lambda: self.link_lookup.contains_link(message) and not matched), generic_lookup),  # skip if specific link already matched
-            ((lambda: 'undertale' in message.lower()), undertale),
-            (tweet_trigger, lambda: self.twitter.tweet(message)),
-            # ((lambda: unit_converter.contains_unit(message)), convert_units)
-        ]
+    def send_titles(self, reply_target, titles):
+        for title in titles:
+            self.send_title(reply_target, title)
 
-        for matcher, func in matchers:
-            if matcher():
-                func()
-                matched = True
+    def convert_units(self, message, reply_target):
+        converted = unit_converter.convert_unit(message)
+        if converted is not None:
+            value, unit = converted
+            self.send_message(reply_target, '^^ %.2f %s' % (value, unit))
 
-        return matched
+    def tweet_trigger(self, message):
+        return self.auto_tweet_regex is not None \
+            and 40 <= len(message) <= 140 \
+            and self.auto_tweet_regex.search(message.lower()) is not None
 
     def get_channel(self, name):
         for channel in self.channels:
@@ -548,9 +649,40 @@ class NDA(IRC):
                 return channel
         return None
 
+    def in_background(self, reply_target, on_done, func, *args, quiet=False):
+        # runs func on the work pool, on_done gets the result from main_loop_iteration in the order the jobs were started
+        if not self.work_pool.submit(reply_target, on_done, func, *args, quiet=quiet) and not quiet:
+            self.send_message(reply_target, 'too busy right now, try again later :(')
+
+    def buffered_link(self, reply_target, name, on_link):
+        # answer right away from the link buffer if it has a fresh link, otherwise search for one in the background
+        link = self.link_buffer.pop(name)
+        if link is not None:
+            on_link(link)
+        else:
+            self.in_background(reply_target, on_link, self.link_buffer.generate, name)
+
+    def stats(self):
+        lines = [
+            'send: %s' % self.send_queue.stats(),
+            'work pool: %s' % self.work_pool.stats(),
+            'link cache: %s' % self.link_lookup.cache.stats(),
+            'probes: %s' % self.link_gen.prober.summary(),
+            'youtube batches: %s' % self.link_lookup.youtube_batcher.stats(),
+            'canned responses: %s' % self.canned_responses.stats(),
+            'scheduler: %s' % self.scheduler.stats(),
+            'link buffer: %s' % self.link_buffer.stats(),
+            'log: %s' % self.logger.stats()
+        ]
+        return lines + self.link_buffer.latency_stats() + self.commands.stats()
+
+    def reload_aliases(self):
+        with open(self.conf_file, 'r', encoding='utf-8') as f:
+            conf = json.load(f)
+        self.aliases.set_aliases(conf.get('aliases', {}))  # the database holds the same map, so it sees the change too
+
     def is_admin(self, nick):
-        return nick in self.admin_sessions and \
-               (datetime.utcnow() - self.admin_sessions[nick]).total_seconds() < self.admin_duration
+        return nick in self.admin_sessions  # sessions are removed by a scheduled job when they run out
 
     def process_mail(self, to):
         messages = self.database.mail_unread_messages(to)
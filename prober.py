@@ -0,0 +1,147 @@
+import math
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+
+class ProbeStats:
+    __slots__ = ('tries', 'hits', 'errors')
+
+    def __init__(self):
+        self.tries = 0
+        self.hits = 0
+        self.errors = 0
+
+
+class Prober:
+    """
+    Looks for a random url that exists by checking several random candidates at once and taking the first hit.
+    Checks for all generators share one pool of threads, which caps the total number of requests in flight, and
+    each host only gets a few of those at a time. The host limit is applied before submitting, so pool threads are
+    never parked waiting for a host slot while other generators' checks queue behind them. How many candidates go out at once adapts to how often a generator
+    hits: a generator that almost always finds something on the first try doesn't fire off a batch every time.
+    """
+    max_concurrency = 8  # requests in flight over all generators
+    host_concurrency = 4  # requests in flight to the same host
+    min_batch = 1
+    max_batch = 8
+    target_probability = 0.9  # size batches so that at least one candidate hits with this probability
+
+    def __init__(self, max_concurrency=None):
+        max_concurrency = max_concurrency if max_concurrency is not None else self.max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='prober')
+        self.host_in_flight = defaultdict(int)  # host => checks submitted and not finished yet
+        self.host_condition = threading.Condition()
+        self.stats = defaultdict(ProbeStats)  # generator name => ProbeStats
+        self.lock = threading.Lock()
+
+    def probe(self, name, candidate, check, max_tries):
+        """
+        calls check(url) on urls from candidate() until one returns True and returns that url, or None after max_tries.
+        raises the error of the last check if every check in a batch raised, e.g. when the host is down.
+        """
+        found = threading.Event()  # lets checks that haven't started yet skip their request
+        tries = 0
+
+        while tries < max_tries:
+            batch = min(self.batch_size(name), max_tries - tries)
+            urls = self._reserve_hosts([candidate() for _ in range(batch)])
+            tries += len(urls)
+            pending = set()
+
+            for url in urls:
+                future = self.executor.submit(self._check, name, url, check, found)
+                future.add_done_callback(lambda _, host=urlsplit(url).hostname: self._release_host(host))  # also on cancel
+                pending.add(future)
+
+            errors = 0
+            error = None
+
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    try:
+                        url = future.result()
+                    except Exception as e:
+                        errors += 1
+                        error = e
+                        continue
+
+                    if url is not None:
+                        found.set()
+                        for other in pending:
+                            other.cancel()  # the ones already running finish in the background and are ignored
+                        return url
+
+            if errors == len(urls):
+                raise error
+
+        return None
+
+    def batch_size(self, name):
+        with self.lock:
+            return self._batch_size(self.stats[name])
+
+    def summary(self):
+        with self.lock:
+            return ', '.join(
+                '%s %i/%i hits (%i errors, batch %i)' % (name, s.hits, s.tries, s.errors, self._batch_size(s))
+                for name, s in sorted(self.stats.items())
+            )
+
+    def _batch_size(self, stats):
+        if stats.tries < 10 or stats.hits == 0:
+            return self.max_batch  # no idea yet, or nothing ever hits
+
+        hit_ratio = stats.hits / stats.tries
+        if hit_ratio >= 1:
+            return self.min_batch
+
+        # smallest n with 1 - (1 - hit_ratio)^n >= target_probability
+        n = math.ceil(math.log(1 - self.target_probability) / math.log(1 - hit_ratio))
+        return max(self.min_batch, min(n, self.max_batch))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _reserve_hosts(self, urls):
+        """takes a host slot for as many urls as are free (at least one, waiting if needed) and returns those urls"""
+        with self.host_condition:
+            while True:
+                reserved = []
+                for url in urls:
+                    host = urlsplit(url).hostname
+                    if self.host_in_flight[host] < self.host_concurrency:
+                        self.host_in_flight[host] += 1
+                        reserved.append(url)
+
+                if len(reserved) > 0:
+                    return reserved
+                self.host_condition.wait()  # the calling thread waits here, not a pool thread
+
+    def _release_host(self, host):
+        with self.host_condition:
+            self.host_in_flight[host] -= 1
+            if self.host_in_flight[host] == 0:
+                del self.host_in_flight[host]
+            self.host_condition.notify_all()
+
+    def _check(self, name, url, check, found):
+        if found.is_set():
+            return None
+
+        try:
+            hit = check(url)
+        except Exception:
+            with self.lock:
+                self.stats[name].errors += 1
+            raise
+
+        with self.lock:
+            self.stats[name].tries += 1
+            if hit:
+                self.stats[name].hits += 1
+
+        return url if hit else None
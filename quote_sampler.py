@@ -0,0 +1,109 @@
+import random
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class TimeIndex:
+    """seq_ids ordered by time, so any time range maps to a contiguous slice that can be counted or sampled
+    with a couple of binary searches"""
+
+    def __init__(self):
+        self.times = array('q')
+        self.seq_ids = array('q')
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, timestamp, seq_id):
+        if len(self.times) == 0 or timestamp >= self.times[-1]:
+            self.times.append(timestamp)  # live quotes always arrive in order, so this is the common case
+            self.seq_ids.append(seq_id)
+        else:
+            i = bisect_right(self.times, timestamp)
+            self.times.insert(i, timestamp)
+            self.seq_ids.insert(i, seq_id)
+
+    def _slices(self, time_min, time_max, hidden):
+        lo = bisect_left(self.times, time_min)
+        hi = bisect_right(self.times, time_max)
+        slices = [(lo, hi)]
+
+        # cut hidden time ranges out of the slice, leaving up to one extra slice per hidden range
+        for hidden_min, hidden_max in hidden:
+            hidden_lo = bisect_left(self.times, hidden_min)
+            hidden_hi = bisect_right(self.times, hidden_max)
+            cut = []
+            for lo, hi in slices:
+                if hidden_hi <= lo or hidden_lo >= hi:
+                    cut.append((lo, hi))
+                    continue
+                if lo < hidden_lo:
+                    cut.append((lo, hidden_lo))
+                if hidden_hi < hi:
+                    cut.append((hidden_hi, hi))
+            slices = cut
+
+        return slices
+
+    def count(self, time_min, time_max, hidden=()):
+        return sum(hi - lo for lo, hi in self._slices(time_min, time_max, hidden))
+
+    def pick(self, time_min, time_max, hidden=()):
+        slices = self._slices(time_min, time_max, hidden)
+        total = sum(hi - lo for lo, hi in slices)
+
+        if total == 0:
+            return None
+
+        i = random.randrange(total)
+        for lo, hi in slices:
+            if i < hi - lo:
+                return self.seq_ids[lo + i]
+            i -= hi - lo
+
+
+class QuoteSampler:
+    """in-memory per-channel and per-author time indexes over the quotes table for uniform random picks"""
+
+    def __init__(self):
+        self.channels = {}  # channel -> (TimeIndex of all quotes, {author: TimeIndex})
+
+    def is_loaded(self, channel):
+        return channel in self.channels
+
+    def load(self, channel, rows):
+        everyone = TimeIndex()
+        authors = {}
+
+        for timestamp, seq_id, author in rows:
+            everyone.add(timestamp, seq_id)
+            if author not in authors:
+                authors[author] = TimeIndex()
+            authors[author].add(timestamp, seq_id)
+
+        self.channels[channel] = (everyone, authors)
+
+    def unload(self, channel):
+        self.channels.pop(channel, None)
+
+    def add(self, channel, timestamp, author, seq_id):
+        if channel not in self.channels:
+            return  # nothing to keep in step, the channel will be loaded from the database on first use
+
+        everyone, authors = self.channels[channel]
+        everyone.add(timestamp, seq_id)
+        if author not in authors:
+            authors[author] = TimeIndex()
+        authors[author].add(timestamp, seq_id)
+
+    def _index(self, channel, author):
+        everyone, authors = self.channels[channel]
+        return everyone if author is None else authors.get(author, None)
+
+    def count(self, channel, author, time_min, time_max, hidden=()):
+        index = self._index(channel, author)
+        return index.count(time_min, time_max, hidden) if index is not None else 0
+
+    def pick(self, channel, author, time_min, time_max, hidden=()):
+        index = self._index(channel, author)
+        return index.pick(time_min, time_max, hidden) if index is not None else None
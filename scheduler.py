@@ -0,0 +1,125 @@
+import time
+import heapq
+import itertools
+import threading
+import traceback
+
+
+class Job:
+    __slots__ = ('deadline', 'interval', 'func', 'name', 'inline', 'cancelled')
+
+    def __init__(self, deadline, interval, func, name, inline):
+        self.deadline = deadline  # time.monotonic() when the job should run next
+        self.interval = interval  # seconds between runs for periodic jobs, None for one-shot jobs
+        self.func = func
+        self.name = name
+        self.inline = inline      # run on the connection itself instead of the handler thread (asyncio engine only)
+        self.cancelled = False
+
+    def __repr__(self):
+        return 'Job(%r, deadline=%.3f, interval=%r)' % (self.name, self.deadline, self.interval)
+
+
+class Scheduler:
+    """
+    One place for everything that has to happen at some point in the future instead of in response to a line from
+    the server. Jobs sit in a heap ordered by deadline, so the main loop can ask how long it may sleep and then run
+    exactly the jobs that are due. Jobs can be added from any thread, wakeup() is called whenever a new job becomes
+    the earliest one so a sleeping loop can shorten its sleep.
+    """
+
+    def __init__(self, wakeup=None, log=None):
+        self.wakeup = wakeup
+        self.log = log if log is not None else print
+        self.heap = []                  # (deadline, sequence, job), the sequence keeps equal deadlines in order
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.runs = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_later(self, delay, func, name=None, inline=False):
+        job = Job(time.monotonic() + max(delay, 0), None, func, name or func.__name__, inline)
+        self._push(job)
+        return job
+
+    def call_every(self, interval, func, name=None, delay=None, inline=False):
+        """runs func every interval seconds, the first time after delay seconds (defaults to interval)"""
+        job = Job(time.monotonic() + (delay if delay is not None else interval), interval, func, name or func.__name__, inline)
+        self._push(job)
+        return job
+
+    def cancel(self, job):
+        if job is not None:
+            job.cancelled = True  # dropped when it reaches the top of the heap
+
+    def next_delay(self):
+        """seconds until the next job is due (0 if one is overdue), None if nothing is scheduled"""
+        with self.lock:
+            self._drop_cancelled()
+            if len(self.heap) == 0:
+                return None
+            return max(self.heap[0][0] - time.monotonic(), 0)
+
+    def pop_due(self):
+        """removes and returns the jobs that are due, periodic jobs are scheduled again for their next run"""
+        due = []
+        now = time.monotonic()
+
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                _, _, job = heapq.heappop(self.heap)
+
+                if job.cancelled:
+                    continue
+
+                due.append(job)
+
+                if job.interval is not None:
+                    # skip runs that were missed while the loop was busy instead of running them back to back
+                    job.deadline = max(job.deadline + job.interval, now)
+                    heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+
+            self.runs += len(due)
+
+        return due
+
+    def run_due(self):
+        """runs every due job, one of them failing doesn't cost the rest of the batch their turn"""
+        inline_error = None
+
+        for job in self.pop_due():
+            if job.cancelled:  # an earlier job in the same batch may have cancelled it
+                continue
+
+            try:
+                job.func()
+            except Exception as error:
+                if job.inline:
+                    # connection level, e.g. the ping check raising IRCError, the caller decides after the batch
+                    inline_error = inline_error if inline_error is not None else error
+                else:
+                    self.log('Unknown error in job %s (%s): %s' % (job.name, str(type(error)), error.args))
+                    self.log(traceback.format_exc())
+
+        if inline_error is not None:
+            raise inline_error
+
+    def stats(self):
+        with self.lock:
+            self._drop_cancelled()
+            pending = sorted(job.name for _, _, job in self.heap if not job.cancelled)
+        return 'jobs=%i runs=%i (%s)' % (len(pending), self.runs, ', '.join(pending))
+
+    def _push(self, job):
+        with self.lock:
+            earliest = len(self.heap) == 0 or job.deadline < self.heap[0][0]
+            heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+
+        if earliest and self.wakeup is not None:
+            self.wakeup()
+
+    def _drop_cancelled(self):
+        while len(self.heap) > 0 and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
@@ -0,0 +1,97 @@
+import time
+import threading
+from collections import deque, OrderedDict
+from metrics import Histogram
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate    # tokens added per second
+        self.burst = burst  # most tokens that can be saved up
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class SendQueue:
+    """
+    Outbound lines, with a fifo per target that are served round robin so one channel's burst can't starve another.
+    Every line costs a token from a shared bucket, which keeps the connection under the server's flood limits.
+    """
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.targets = OrderedDict()  # target -> deque of (enqueue time, line)
+        self.depth = 0
+        self.max_depth = 0
+        self.latency = Histogram()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, target, line):
+        now = time.monotonic()
+
+        with self.lock:
+            if target not in self.targets:
+                self.targets[target] = deque()
+            self.targets[target].append((now, line))
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def clear(self):
+        with self.lock:
+            self.targets.clear()
+            self.depth = 0
+
+    def pop_ready(self):
+        """returns every line that can be sent right now, taking one line per target in turn"""
+        now = time.monotonic()
+        lines = []
+
+        with self.lock:
+            while len(self.targets) > 0:
+                for target in list(self.targets.keys()):
+                    fifo = self.targets[target]
+                    if not self.bucket.take(now):
+                        return lines
+
+                    enqueued, line = fifo.popleft()
+                    self.depth -= 1
+                    self.latency.observe(now - enqueued)
+                    lines.append(line)
+
+                    if len(fifo) == 0:
+                        del self.targets[target]
+                    else:
+                        self.targets.move_to_end(target)  # next round starts with whoever has waited longest
+
+        return lines
+
+    def next_send_delay(self):
+        """seconds until pop_ready could return something, or None if nothing is queued"""
+        now = time.monotonic()
+
+        with self.lock:
+            if len(self.targets) == 0:
+                return None
+            return self.bucket.wait_time(now)
+
+    def stats(self):
+        return 'queue depth %i (max %i, %i targets), send latency %s' \
+               % (self.depth, self.max_depth, len(self.targets), self.latency.summary())
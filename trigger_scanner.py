@@ -0,0 +1,149 @@
+import re
+import sys
+import timeit
+
+youtube_pattern = r'(?:youtube\.com/watch\?v=|youtu\.be/)(?P<youtube_id>[a-zA-Z0-9_\-]{11})'
+twitter_pattern = r'twitter\.com/\S+?/status/(?P<tweet_id>\d+)'  # \S+? stays within one word, it can't backtrack across the line
+link_pattern = r'https?://\S+'
+
+youtube_regex = re.compile(youtube_pattern)
+twitter_regex = re.compile(twitter_pattern)
+link_regex = re.compile(link_pattern)
+
+
+class Triggers:
+    """everything implicit_command could react to in one message, each list in order of appearance without duplicates"""
+    __slots__ = ('youtube_ids', 'tweet_ids', 'links', 'canned')
+
+    def __init__(self):
+        self.youtube_ids = []
+        self.tweet_ids = []
+        self.links = []   # links that aren't youtube videos or tweets
+        self.canned = []  # lower case canned response trigger words
+
+    def __bool__(self):
+        return len(self.youtube_ids) > 0 or len(self.tweet_ids) > 0 or len(self.links) > 0 or len(self.canned) > 0
+
+    def __repr__(self):
+        return 'Triggers(%r, %r, %r, %r)' % (self.youtube_ids, self.tweet_ids, self.links, self.canned)
+
+
+class TriggerScanner:
+    """
+    Finds youtube videos, tweets, other links and canned response trigger words with a single pass of one combined
+    regex over the message. Words inside a link are only looked at again within that link, never the whole line.
+    """
+    max_links = 5  # per kind, the rest of a link dump is ignored
+
+    def __init__(self, canned_triggers=()):
+        canned_triggers = sorted((trigger.lower() for trigger in canned_triggers), key=len, reverse=True)
+        alternatives = [
+            '(?P<link>%s)' % link_pattern,
+            '(?P<youtube>%s)' % youtube_pattern,
+            '(?P<twitter>%s)' % twitter_pattern
+        ]
+        first_chars = set('hytHYT')
+        self.canned_regex = None
+
+        if len(canned_triggers) > 0:
+            canned = '|'.join(re.escape(trigger) for trigger in canned_triggers)
+            alternatives.append('(?P<canned>(?i:%s))' % canned)
+            first_chars.update(trigger[0].lower() + trigger[0].upper() for trigger in canned_triggers)
+            self.canned_regex = re.compile(canned, re.IGNORECASE)
+
+        # the lookahead lets the engine skip positions that can't start any alternative with a single class test
+        first_chars = ''.join(sorted(re.escape(char) for chars in first_chars for char in chars))
+        self.regex = re.compile('(?=[%s])(?:%s)' % (first_chars, '|'.join(alternatives)))
+
+    def scan(self, message):
+        triggers = Triggers()
+
+        for match in self.regex.finditer(message):
+            kind = match.lastgroup
+            text = match.group(0)
+
+            if kind == 'link':
+                self._scan_link(triggers, self._trim_link(text))
+            elif kind == 'youtube':
+                self._add(triggers.youtube_ids, match.group('youtube_id'))
+            elif kind == 'twitter':
+                self._add(triggers.tweet_ids, match.group('tweet_id'))
+            else:
+                self._add(triggers.canned, text.lower())
+
+        return triggers
+
+    def _trim_link(self, link):
+        # punctuation after a link is almost never part of it, and neither is a closing paren without an opening one
+        # inside the link, e.g. "(see http://x.y/z)". balanced ones stay, like in wikipedia links
+        while True:
+            link = link.rstrip('.,;:!?\'">')
+            if link.endswith(')') and link.count(')') > link.count('('):
+                link = link[:-1]
+            else:
+                return link
+
+    def _scan_link(self, triggers, link):
+        youtube_match = youtube_regex.search(link)
+        twitter_match = twitter_regex.search(link)
+
+        if youtube_match is not None:
+            self._add(triggers.youtube_ids, youtube_match.group('youtube_id'))
+        elif twitter_match is not None:
+            self._add(triggers.tweet_ids, twitter_match.group('tweet_id'))
+        else:
+            self._add(triggers.links, link)
+
+        if self.canned_regex is not None:
+            for match in self.canned_regex.finditer(link):
+                self._add(triggers.canned, match.group(0).lower())
+
+    def _add(self, found, value):
+        if value not in found and len(found) < self.max_links:
+            found.append(value)
+
+
+def _legacy_scan(message, auto_tweet_regex=None):
+    # the checks implicit_command used to run, each one a separate pass over the line
+    youtube = re.search(r'(youtube.com/watch\?v=|youtu.be/)([a-zA-Z0-9_\-]{11})', message) is not None
+    twitter = re.search(r'twitter.com/.+/status/(\d+)', message) is not None
+    link = re.search(r'.*(http(s)?://.+)(\s+|$)', message) is not None
+    undertale = 'undertale' in message.lower()
+    return youtube, twitter, link, undertale
+
+
+link_cases = [
+    ('look at https://example.com/a.', ['https://example.com/a']),
+    ('(see http://x.y/z)', ['http://x.y/z']),
+    ('(see http://x.y/z).', ['http://x.y/z']),
+    ('https://en.wikipedia.org/wiki/Python_(programming_language)', ['https://en.wikipedia.org/wiki/Python_(programming_language)']),
+    ('(https://en.wikipedia.org/wiki/Python_(programming_language))', ['https://en.wikipedia.org/wiki/Python_(programming_language)']),
+    ('"http://x.y/q?a=1"', ['http://x.y/q?a=1']),
+]
+
+
+benchmark_messages = {
+    'chat': 'haha yeah i know what you mean, i was there last week and it was pretty much the same thing',
+    'link': 'look at this https://www.youtube.com/watch?v=dQw4w9WgXcQ and https://example.com/some/article.html',
+    'long': 'lorem ipsum dolor sit amet ' * 400,
+    'long link': 'lorem ipsum dolor sit amet ' * 200 + 'https://example.com/a ' + 'lorem ipsum ' * 200,
+    'no space': 'a' * 10000,
+    'many twitter': 'twitter.com/a/ ' * 500,
+}
+
+
+if __name__ == '__main__':
+    # e.g. python3 trigger_scanner.py 200
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    scanner = TriggerScanner(['undertale'])
+
+    for message, links in link_cases:
+        if scanner.scan(message).links != links:
+            sys.exit('links in %r: expected %r, got %r' % (message, links, scanner.scan(message).links))
+    print('%i link cases ok' % len(link_cases))
+    print('%-14s %7s %14s %14s' % ('message', 'chars', 'scanner', 'old checks'))
+
+    for name, message in benchmark_messages.items():
+        new = min(timeit.repeat(lambda: scanner.scan(message), number=runs, repeat=3)) / runs
+        old = min(timeit.repeat(lambda: _legacy_scan(message), number=runs, repeat=3)) / runs
+        print('%-14s %7i %11.1f us %11.1f us' % (name, len(message), new * 1e6, old * 1e6))
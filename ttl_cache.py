@@ -0,0 +1,101 @@
+import sys
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A bounded LRU cache where entries also expire after a while. None is a valid value and means "we looked and there
+    was nothing", those negative entries expire sooner so a temporary failure doesn't stick around for long.
+    With a filename, entries are also written to a small sqlite database so they survive restarts.
+    """
+    max_entries = 1024
+    ttl = 6 * 60 * 60       # seconds a found value is kept
+    negative_ttl = 10 * 60  # seconds a None is kept
+
+    def __init__(self, max_entries=None, ttl=None, negative_ttl=None, filename=None):
+        self.max_entries = max_entries if max_entries is not None else self.max_entries
+        self.ttl = ttl if ttl is not None else self.ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else self.negative_ttl
+        self.entries = OrderedDict()  # key => (expires, value), least recently used first
+        self.lock = threading.Lock()  # lookups run on several worker threads
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+
+        if filename is not None:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self.db.execute('DELETE FROM cache WHERE expires<?', (time.time(),))
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """returns (True, value) for a live entry, otherwise (False, None)"""
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key, None)
+
+            if entry is None and self.db is not None:
+                entry = self.db.execute('SELECT expires, value FROM cache WHERE key=?', (key,)).fetchone()
+                if entry is not None:
+                    self._remember(key, entry)
+
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value):
+        entry = (time.time() + (self.ttl if value is not None else self.negative_ttl), value)
+
+        with self.lock:
+            self._remember(key, entry)
+
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)', (key,) + entry)
+                self.db.commit()
+
+    def get_or_fetch(self, key, fetch):
+        found, value = self.get(key)
+
+        if not found:
+            value = fetch()  # outside the lock, fetching is the slow part
+            self.put(key, value)
+
+        return value
+
+    def memory_usage(self):
+        """rough number of bytes held by the in-memory entries"""
+        with self.lock:
+            return sys.getsizeof(self.entries) + sum(
+                sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry[1])
+                for key, entry in self.entries.items()
+            )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups > 0 else 0
+        return 'entries=%i hits=%i misses=%i hit_rate=%.1f%% memory=%.1fkB' \
+               % (len(self.entries), self.hits, self.misses, hit_rate, self.memory_usage() / 1024)
+
+    def close(self):
+        with self.lock:  # a lookup may still be finishing on a worker thread
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -1,8 +1,38 @@
 import sys
+from functools import lru_cache
 from datetime import datetime, timezone
 
 
+class AliasMap:
+    memo_size = 8192  # how many raw nicks to remember the normalized form of
+
+    def __init__(self, aliases=None):
+        self.aliases = {}
+        self.masters = {}
+        self.normalize = lru_cache(maxsize=self.memo_size)(self._normalize)
+        self.set_aliases(aliases if aliases is not None else {})
+
+    def set_aliases(self, aliases):
+        # reverse index of alias -> master. the first master to claim a nick wins, like a linear search would
+        masters = {}
+        for master, master_aliases in aliases.items():
+            masters.setdefault(master, master)
+            for alias in master_aliases:
+                masters.setdefault(alias, master)
+
+        self.aliases = aliases
+        self.masters = masters
+        self.normalize.cache_clear()
+
+    def _normalize(self, nick):
+        nick = nick.lower().lstrip('~&@%+ ').strip('_ ')  # try to normalize nicks to lowercase versions and no alts
+        return self.masters.get(nick, nick)
+
+
 def normalize_nick(nick, aliases_map):
+    if isinstance(aliases_map, AliasMap):
+        return aliases_map.normalize(nick)
+
     nick = nick.lower().lstrip('~&@%+ ').strip('_ ')  # try to normalize nicks to lowercase versions and no alts
 
     for (master, aliases) in aliases_map.items():
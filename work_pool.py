@@ -0,0 +1,144 @@
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+
+class Job:
+    __slots__ = ('future', 'submitted', 'deadline', 'on_done', 'quiet')
+
+    def __init__(self, future, submitted, deadline, on_done, quiet):
+        self.future = future
+        self.submitted = submitted
+        self.deadline = deadline
+        self.on_done = on_done
+        self.quiet = quiet  # nobody asked for it explicitly (e.g. link titles), so it may be cancelled to make room
+
+
+class WorkPool:
+    """
+    Runs slow calls (http lookups, pastebin uploads, tweets) on a few worker threads so they don't hold up the irc loop.
+    Jobs are queued per key (the reply target) and deliver() hands finished results to their callbacks on the calling
+    thread, in the order the jobs were submitted for that key, so replies never overtake each other in a channel.
+
+    A job that misses its deadline is dropped. Threads can't be interrupted, so a job that is already running still
+    finishes in the background, but its result is thrown away and it no longer blocks the jobs queued behind it.
+    When max_pending jobs are waiting, the oldest quiet one that hasn't started yet is cancelled to make room, jobs
+    someone is waiting on (commands) are never evicted, they're only rejected up front when nothing can make room.
+    """
+    workers = 4
+    max_pending = 16  # jobs submitted but not delivered yet, over all keys
+    deadline = 20     # seconds from submitting until the result is no longer worth delivering
+
+    def __init__(self, workers=None, log=None, on_ready=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or self.workers, thread_name_prefix='work-pool')
+        self.log = log if log is not None else print
+        self.on_ready = on_ready  # called from the worker thread when a job finishes, e.g. to schedule deliver()
+        self.queues = OrderedDict()  # key => deque of Jobs, oldest first
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def submit(self, key, on_done, func, *args, deadline=None, quiet=False):
+        """
+        calls func(*args) on a worker and later on_done(result) from deliver(), on_done may be None.
+        returns False if the pool is saturated and the job was rejected.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending and not self._cancel_oldest_waiting():
+                self.rejected += 1
+                return False
+
+            now = time.monotonic()
+            job = Job(
+                self.executor.submit(func, *args),
+                now,
+                now + (deadline if deadline is not None else self.deadline),
+                on_done,
+                quiet
+            )
+            self.queues.setdefault(key, deque()).append(job)
+            self.pending += 1
+
+        if self.on_ready is not None:
+            job.future.add_done_callback(lambda future: self.on_ready())
+        return True
+
+    def deliver(self):
+        """runs the callbacks of finished jobs, call this regularly from the thread that owns the connection"""
+        ready = []
+        now = time.monotonic()
+
+        with self.lock:
+            for key, queue in list(self.queues.items()):
+                while len(queue) > 0:
+                    job = queue[0]
+
+                    if job.future.done():
+                        ready.append(job)
+                    elif now >= job.deadline:
+                        job.future.cancel()  # a no-op if it's already running, the result is ignored either way
+                        self.expired += 1
+                    else:
+                        break  # later jobs for this key wait their turn
+
+                    queue.popleft()
+                    self.pending -= 1
+
+                if len(queue) == 0:
+                    del self.queues[key]
+
+        for job in ready:
+            try:
+                result = job.future.result()
+            except CancelledError:
+                continue
+            except Exception as error:
+                self.failed += 1
+                self.log('Work pool job failed (%s): %s' % (str(type(error)), error.args))
+                continue
+
+            self.completed += 1
+            if job.on_done is not None:
+                try:
+                    job.on_done(result)
+                except Exception as error:  # the rest of the batch is already off the queues, don't lose it too
+                    self.failed += 1
+                    self.log('Work pool callback failed (%s): %s' % (str(type(error)), error.args))
+
+    def stats(self):
+        return 'pending=%i completed=%i expired=%i cancelled=%i rejected=%i failed=%i' \
+               % (self.pending, self.completed, self.expired, self.cancelled, self.rejected, self.failed)
+
+    def shutdown(self):
+        with self.lock:
+            for queue in self.queues.values():
+                for job in queue:
+                    job.future.cancel()
+            self.queues.clear()
+            self.pending = 0
+
+        self.executor.shutdown(wait=False)
+
+    def _cancel_oldest_waiting(self):
+        oldest_key, oldest_job = None, None
+
+        for key, queue in self.queues.items():
+            for job in queue:
+                if job.quiet and not job.future.running() and not job.future.done() \
+                        and (oldest_job is None or job.submitted < oldest_job.submitted):
+                    oldest_key, oldest_job = key, job
+
+        if oldest_job is None or not oldest_job.future.cancel():
+            return False
+
+        self.queues[oldest_key].remove(oldest_job)
+        if len(self.queues[oldest_key]) == 0:
+            del self.queues[oldest_key]
+        self.pending -= 1
+        self.cancelled += 1
+        return True